@@ -24,6 +24,11 @@ class IRCChannel(object):
 		Accepts any keyword arguments accepted by IRCUser.sendMessage.
 		Also accepts the following keyword arguments:
 		- skip: list of users in the channel to skip when sending the message
+		- conditionalTags: dict of tags to add for users who pass the
+		    associated check, as generated by the sendingusertags action
+		    Conditional tags are evaluated once for each distinct set of
+		    capabilities among the recipients, so the checks should depend
+		    only on the user's negotiated capabilities.
 		"""
 		if "to" not in kw:
 			kw["to"] = self.name
@@ -44,15 +49,23 @@ class IRCChannel(object):
 		if "conditionalTags" in kw:
 			conditionalTags = kw["conditionalTags"]
 			del kw["conditionalTags"]
+		lineCache = {} # Users receiving identical lines share the serialized message
+		# Each group of users with the same capabilities shares one tags dict and its line cache key
+		baseTagsKey = tuple(sorted(baseTags.iteritems())) if baseTags else None
+		tagsByCapabilities = {}
 		for user in userList:
+			userKW = kw.copy()
 			if conditionalTags:
-				tags = baseTags.copy()
-				addTags = user.filterConditionalTags(conditionalTags)
-				tags.update(addTags)
+				capabilities = frozenset(user.cache["capabilities"]) if "capabilities" in user.cache else frozenset()
+				if capabilities not in tagsByCapabilities:
+					tags = baseTags.copy()
+					tags.update(user.filterConditionalTags(conditionalTags))
+					tagsByCapabilities[capabilities] = (tags, tuple(sorted(tags.iteritems())) if tags else None)
+				userKW["tags"], userKW["tagsKey"] = tagsByCapabilities[capabilities]
 			else:
-				tags = baseTags
-			kw["tags"] = tags
-			user.sendMessage(command, *params, **kw)
+				userKW["tags"] = baseTags
+				userKW["tagsKey"] = baseTagsKey
+			user.sendSharedMessage(lineCache, command, *params, **userKW)
 	
 	def sendServerMessage(self, command, *params, **kw):
 		"""
@@ -1,8 +1,37 @@
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
 from twisted.protocols.basic import LineOnlyReceiver
+from zope.interface import implements
+import re
+
+_tagEscapeSequence = re.compile(r"\\(.?)", re.DOTALL)
+_tagUnescapes = {
+	"\\": "\\",
+	":": ";",
+	"r": "\r",
+	"n": "\n",
+	"s": " "
+}
+def _unescapeTagValueChar(match):
+	char = match.group(1)
+	return _tagUnescapes.get(char, char)
 
 class IRCBase(LineOnlyReceiver):
+	implements(IPushProducer)
+	
 	delimiter = "\n" # Default to splitting by \n, and then we'll also split \r in the handler
 	
+	# Output buffering is off unless a subclass enables it for the connection
+	_bufferOutput = False
+	_outputBufferHighWater = 16384
+	_outputBuffer = None
+	_outputBufferSize = 0
+	_outputFlushCall = None
+	# When registered as a producer with the transport, output is held while the transport's buffer is full
+	_producerRegistered = False
+	_outputPaused = False
+	_sendQLimit = None
+	
 	def lineReceived(self, data):
 		for line in data.split("\r"):
 			command, params, prefix, tags = self._parseLine(line)
@@ -10,42 +39,33 @@ class IRCBase(LineOnlyReceiver):
 				self.handleCommand(command, params, prefix, tags)
 	
 	def _parseLine(self, line):
-		line = line.replace("\0", "")
+		if "\0" in line:
+			line = line.replace("\0", "")
 		if not line:
 			return None, None, None, None
 		
 		if line[0] == "@":
-			if " " not in line:
+			tagLine, space, line = line.partition(" ")
+			if not line:
 				return None, None, None, None
-			tagLine, line = line.split(" ", 1)
 			tags = self._parseTags(tagLine[1:])
 		else:
 			tags = {}
 		
 		prefix = None
 		if line[0] == ":":
-			if " " not in line:
+			prefix, space, line = line.partition(" ")
+			if not space:
 				return None, None, None, None
-			prefix, line = line.split(" ", 1)
 			prefix = prefix[1:]
 		
-		if " :" in line:
-			linePart, lastParam = line.split(" :", 1)
-		else:
-			linePart = line
-			lastParam = None
+		linePart, lastParamSeparator, lastParam = line.partition(" :")
 		if not linePart:
 			return None, None, None, None
 		
-		if " " in linePart:
-			command, paramLine = linePart.split(" ", 1)
-			params = paramLine.split(" ")
-		else:
-			command = linePart
-			params = []
-		while "" in params:
-			params.remove("")
-		if lastParam is not None:
+		command, space, paramLine = linePart.partition(" ")
+		params = [param for param in paramLine.split(" ") if param]
+		if lastParamSeparator:
 			params.append(lastParam)
 		return command.upper(), params, prefix, tags
 	
@@ -54,34 +74,11 @@ class IRCBase(LineOnlyReceiver):
 		for tagval in tagLine.split(";"):
 			if not tagval:
 				continue
-			if "=" in tagval:
-				tag, escapedValue = tagval.split("=", 1)
-				escaped = False
-				valueChars = []
-				for char in escapedValue:
-					if char == "\\":
-						escaped = True
-						continue
-					if escaped:
-						if char == "\\":
-							valueChars.append("\\")
-						elif char == ":":
-							valueChars.append(";")
-						elif char == "r":
-							valueChars.append("\r")
-						elif char == "n":
-							valueChars.append("\n")
-						elif char == "s":
-							valueChars.append(" ")
-						else:
-							valueChars.append(char)
-						escaped = False
-						continue
-					valueChars.append(char)
-				value = "".join(valueChars)
-			else:
-				tag = tagval
+			tag, equals, value = tagval.partition("=")
+			if not equals:
 				value = None
+			elif "\\" in value:
+				value = _tagEscapeSequence.sub(_unescapeTagValueChar, value)
 			tags[tag] = value
 		return tags
 	
@@ -89,6 +86,9 @@ class IRCBase(LineOnlyReceiver):
 		pass
 	
 	def sendMessage(self, command, *params, **kw):
+		self.sendLine(self._buildMessageLine(command, *params, **kw))
+	
+	def _buildMessageLine(self, command, *params, **kw):
 		if "tags" in kw:
 			tags = self._buildTagString(kw["tags"])
 		else:
@@ -103,13 +103,15 @@ class IRCBase(LineOnlyReceiver):
 			alwaysPrefixLastParam = False
 		params = list(params)
 		if params:
-			for param in params[:-1]:
-				for badChar in (" ", "\r", "\n", "\0"):
-					if badChar in param:
-						raise ValueError("Illegal character {!r} found in parameter {!r}".format(badChar, param))
-			for badChar in ("\r", "\n", "\0"):
-				if badChar in params[-1]:
-					raise ValueError("Illegal character {!r} found in parameter {!r}".format(badChar, params[-1]))
+			# Trusted parameters are server-generated text that was checked when it was built
+			if not kw.get("trusted", False):
+				for param in params[:-1]:
+					for badChar in (" ", "\r", "\n", "\0"):
+						if badChar in param:
+							raise ValueError("Illegal character {!r} found in parameter {!r}".format(badChar, param))
+				for badChar in ("\r", "\n", "\0"):
+					if badChar in params[-1]:
+						raise ValueError("Illegal character {!r} found in parameter {!r}".format(badChar, params[-1]))
 			if alwaysPrefixLastParam or not params[-1] or " " in params[-1] or params[-1][0] == ":":
 				params[-1] = ":{}".format(params[-1])
 		lineToSend = ""
@@ -118,7 +120,7 @@ class IRCBase(LineOnlyReceiver):
 		if prefix:
 			lineToSend += ":{} ".format(prefix)
 		lineToSend += "{} {}".format(command, " ".join(params))
-		self.sendLine(lineToSend.replace("\0", ""))
+		return lineToSend.replace("\0", "")
 	
 	def _buildTagString(self, tags):
 		tagList = []
@@ -136,4 +138,110 @@ class IRCBase(LineOnlyReceiver):
 		return ";".join(tagList)
 	
 	def sendLine(self, line):
-		return self.transport.write("{}\r\n".format(line))
\ No newline at end of file
+		if not self._bufferOutput and not self._outputPaused:
+			return self.transport.write("{}\r\n".format(line))
+		if self._outputBuffer is None:
+			self._outputBuffer = []
+		self._outputBuffer.append(line)
+		self._outputBuffer.append("\r\n")
+		self._outputBufferSize += len(line) + 2
+		if self._outputPaused:
+			if self._sendQLimit is not None and self.sendQueueSize() > self._sendQLimit:
+				self._outputBuffer = []
+				self._outputBufferSize = 0
+				self.sendQExceeded()
+			return
+		if self._outputBufferSize >= self._outputBufferHighWater:
+			self.flushOutput() # Don't let the buffer grow past the high-water mark; hand the data to the transport now
+		elif self._outputFlushCall is None:
+			self._outputFlushCall = reactor.callLater(0, self.flushOutput)
+	
+	def flushOutput(self):
+		"""
+		Writes any buffered outgoing lines to the transport. Buffered output
+		is flushed automatically at the end of the current reactor iteration,
+		but this should be called before closing the connection.
+		"""
+		if self._outputFlushCall is not None:
+			if self._outputFlushCall.active():
+				self._outputFlushCall.cancel()
+			self._outputFlushCall = None
+		if not self._outputBuffer or self._outputPaused:
+			return
+		outputBuffer = self._outputBuffer
+		self._outputBuffer = []
+		self._outputBufferSize = 0
+		self.transport.writeSequence(outputBuffer)
+	
+	def sendQueueSize(self):
+		"""
+		Returns the number of bytes of output waiting to be sent, counting both
+		the output held here and the output the transport hasn't written to
+		the socket yet.
+		"""
+		return self._outputBufferSize + self._transportBufferSize()
+	
+	def _transportBufferSize(self):
+		# Twisted's socket transports keep unwritten data in dataBuffer (of which offset bytes are already
+		# written) and _tempDataBuffer (of _tempDataLen bytes). TLS transports wrap the socket transport.
+		transport = self.transport
+		bufferSize = 0
+		while transport is not None:
+			dataBuffer = getattr(transport, "dataBuffer", None)
+			if dataBuffer is not None:
+				bufferSize += len(dataBuffer) - getattr(transport, "offset", 0) + getattr(transport, "_tempDataLen", 0)
+				break
+			transport = getattr(transport, "transport", None)
+		return bufferSize
+	
+	def sendQExceeded(self):
+		"""
+		Called when the output held back for a slow connection exceeds the
+		send queue limit. The held output has already been discarded.
+		"""
+		pass
+	
+	def registerOutputProducer(self):
+		"""
+		Registers this connection as a producer with its transport so that
+		output is held in the send queue while the transport's buffer is full.
+		"""
+		if self._producerRegistered:
+			return
+		self.transport.registerProducer(self, True)
+		self._producerRegistered = True
+	
+	def closeConnection(self, abort = False):
+		"""
+		Writes any remaining output and closes the connection.
+		If abort is True, the remaining output is discarded and the connection
+		is closed right away instead. Use this for connections that aren't
+		reading what we send them, which would otherwise stay open until the
+		output could be written.
+		"""
+		if abort:
+			self._outputPaused = True
+			self._outputBuffer = []
+			self._outputBufferSize = 0
+		else:
+			self._outputPaused = False
+			self.flushOutput()
+		if self._producerRegistered:
+			self._producerRegistered = False
+			self.transport.unregisterProducer() # Some transports (TLS) won't close while a producer is registered
+		if abort:
+			self.transport.abortConnection()
+		else:
+			self.transport.loseConnection()
+	
+	def pauseProducing(self):
+		self._outputPaused = True
+	
+	def resumeProducing(self):
+		self._outputPaused = False
+		self.flushOutput()
+	
+	def stopProducing(self):
+		self._outputPaused = True
+		self._outputBuffer = []
+		self._outputBufferSize = 0
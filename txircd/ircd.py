@@ -9,10 +9,16 @@ from twisted.python.rebuild import rebuild
 from txircd.config import Config, ConfigError, ConfigValidationError
 from txircd.factory import ServerConnectFactory, ServerListenFactory, UserFactory
 from txircd.module_interface import ICommand, IMode, IModuleData
-from txircd.utils import CaseInsensitiveDictionary, ModeType, now, unescapeEndpointDescription
+from txircd.storage import JournalStorage, ShelveStorage
+from txircd.utils import CaseInsensitiveDictionary, ModeType, now, splitMessage, unescapeEndpointDescription
+from collections import deque
 from datetime import timedelta
+from functools import partial
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import time
 from weakref import WeakValueDictionary
-import importlib, random, re, shelve, string, txircd.modules
+import importlib, random, re, string, txircd.modules
 
 class IRCd(Service):
 	def __init__(self, configFileName):
@@ -37,6 +43,10 @@ class IRCd(Service):
 		self.storageSyncer = None
 		self.dataCache = {}
 		self.functionCache = {}
+		self._actionPlanCache = {}
+		self._userModeActionIndex = {}
+		self._channelModeActionIndex = {}
+		self._registrationInfoCache = {}
 		
 		self.serverID = None
 		self.name = None
@@ -56,6 +66,13 @@ class IRCd(Service):
 		self.recentlyDestroyedChannels = CaseInsensitiveDictionary()
 		self.pruneRecentlyQuit = None
 		self.pruneRecentChannels = None
+		self._commandQueueUsers = deque()
+		self._commandQueueUserSet = set() # The users in _commandQueueUsers, to keep each user from being queued twice
+		self._commandQueueCall = None
+		self._expiryHeap = []
+		self._expirySequence = count()
+		self._cancelledExpiryCount = 0
+		self._expiryCall = None
 		
 		self._logFilter = LogLevelFilterPredicate()
 		filterObserver = FilteringLogObserver(globalLogPublisher, (self._logFilter,))
@@ -71,8 +88,14 @@ class IRCd(Service):
 		self.name = self.config["server_name"]
 		self.serverID = self.config["server_id"]
 		self.log.info("Loading storage...")
-		self.storage = shelve.open(self.config["datastore_path"], writeback=True)
-		self.storageSyncer = LoopingCall(self.storage.sync)
+		if self.config.get("datastore_backend", "shelve") == "journal":
+			self.storage = JournalStorage(self.config.get("datastore_journal_path", "data.journal"), self.config["datastore_path"])
+		else:
+			self.storage = ShelveStorage(self.config["datastore_path"])
+		if self.config.get("datastore_thread_sync", False) and hasattr(self.storage, "syncInThread"):
+			self.storageSyncer = LoopingCall(self.storage.syncInThread)
+		else:
+			self.storageSyncer = LoopingCall(self.storage.sync)
 		self.storageSyncer.start(self.config.get("storage_sync_interval", 5), now=False)
 		self.log.info("Starting processes...")
 		self.pruneRecentlyQuit = LoopingCall(self.pruneQuit)
@@ -102,19 +125,25 @@ class IRCd(Service):
 				for user in allUsers:
 					if user[:3] == server.serverID:
 						del self.users[user]
-				server.transport.loseConnection()
+				server.closeConnection()
 		self.log.info("Disconnecting users...")
 		userList = self.users.values() # Basically do the same thing I just did with the servers
 		self.users = {}
 		for user in userList:
 			if user.transport:
 				stopDeferreds.append(user.disconnectedDeferred)
-				user.transport.loseConnection()
+				user.closeConnection()
 		self.log.info("Unloading modules...")
 		moduleList = self.loadedModules.keys()
 		for module in moduleList:
 			self._unloadModule(module, False) # Incomplete unload is done to save time and because side effects are destroyed anyway
 		self.log.info("Stopping processes...")
+		if self._commandQueueCall is not None and self._commandQueueCall.active():
+			self._commandQueueCall.cancel()
+		self._commandQueueCall = None
+		if self._expiryCall is not None and self._expiryCall.active():
+			self._expiryCall.cancel()
+		self._expiryCall = None
 		if self.pruneRecentlyQuit.running:
 			self.pruneRecentlyQuit.stop()
 		if self.pruneRecentChannels.running:
@@ -249,6 +278,7 @@ class IRCd(Service):
 			for mode, implementation in typeSet.iteritems():
 				self.channelModeTypes[mode] = modeType
 				self.channelModes[modeType][mode] = implementation
+				self._indexModeActions(self._channelModeActionIndex, self.channelModeTypes, mode, implementation)
 		for mode, data in newChannelStatuses.iteritems():
 			self.channelModeTypes[mode] = ModeType.Status
 			self.channelStatuses[mode] = data
@@ -263,16 +293,19 @@ class IRCd(Service):
 			for mode, implementation in typeSet.iteritems():
 				self.userModeTypes[mode] = modeType
 				self.userModes[modeType][mode] = implementation
+				self._indexModeActions(self._userModeActionIndex, self.userModeTypes, mode, implementation)
 		for action, actionList in newActions.iteritems():
-			if action not in self.actions:
-				self.actions[action] = []
+			handlerList = list(self.actions.get(action, [])) # Copy so that any action currently being run isn't affected
 			for actionData in actionList:
-				for index, handlerData in enumerate(self.actions[action]):
+				for index, handlerData in enumerate(handlerList):
 					if handlerData[1] < actionData[1]:
-						self.actions[action].insert(index, actionData)
+						handlerList.insert(index, actionData)
 						break
 				else:
-					self.actions[action].append(actionData)
+					handlerList.append(actionData)
+			self.actions[action] = handlerList
+		self._actionPlanCache.clear()
+		self._registrationInfoCache.clear()
 		for command, dataList in newUserCommands.iteritems():
 			if command not in self.userCommands:
 				self.userCommands[command] = []
@@ -348,6 +381,7 @@ class IRCd(Service):
 				self.channelStatusOrder.remove(modeData[0])
 			else:
 				del self.channelModes[modeData[1]][modeData[0]]
+				self._unindexModeActions(self._channelModeActionIndex, modeData[0], modeData[2])
 			del self.channelModeTypes[modeData[0]]
 		for modeData in moduleData["usermodes"]:
 			if fullUnload: # Unset modes on full unload
@@ -364,11 +398,17 @@ class IRCd(Service):
 							user.setModes([(False, modeData[0], user.modes[modeData[0]])], self.serverID)
 			
 			del self.userModes[modeData[1]][modeData[0]]
+			self._unindexModeActions(self._userModeActionIndex, modeData[0], modeData[2])
 			del self.userModeTypes[modeData[0]]
 		for actionData in moduleData["actions"]:
-			self.actions[actionData[0]].remove((actionData[2], actionData[1]))
-			if not self.actions[actionData[0]]:
+			handlerList = list(self.actions[actionData[0]])
+			handlerList.remove((actionData[2], actionData[1]))
+			if handlerList:
+				self.actions[actionData[0]] = handlerList
+			else:
 				del self.actions[actionData[0]]
+		self._actionPlanCache.clear()
+		self._registrationInfoCache.clear()
 		for commandData in moduleData["usercommands"]:
 			self.userCommands[commandData[0]].remove((commandData[2], commandData[1]))
 			if not self.userCommands[commandData[0]]:
@@ -393,6 +433,31 @@ class IRCd(Service):
 	def _removeFromUnloadingList(self, _, moduleName):
 		del self._unloadingModules[moduleName]
 	
+	def _indexModeActions(self, index, modeTypes, mode, modeObj):
+		"""
+		Adds a mode to an action-to-modes index. Each action in the index maps
+		to a list of (mode, modeObj, priority) tuples for the modes affecting
+		it, kept in mode type order.
+		"""
+		for actionName in modeObj.affectedActions:
+			if actionName not in index:
+				index[actionName] = []
+			index[actionName].append((mode, modeObj, modeObj.affectedActions[actionName]))
+			index[actionName].sort(key=lambda modeData: modeTypes[modeData[0]])
+	
+	def _unindexModeActions(self, index, mode, modeObj):
+		"""
+		Removes a mode from an action-to-modes index.
+		"""
+		for actionName in modeObj.affectedActions:
+			if actionName not in index:
+				continue
+			modeList = [modeData for modeData in index[actionName] if modeData[0] != mode]
+			if modeList:
+				index[actionName] = modeList
+			else:
+				del index[actionName]
+	
 	def reloadModule(self, moduleName):
 		"""
 		Reloads the module with the given name.
@@ -488,6 +553,16 @@ class IRCd(Service):
 						config["links"][desc]["out_password"] = str(server["out_password"])
 		if "datastore_path" not in config:
 			config["datastore_path"] = "data.db"
+		if "datastore_backend" in config and config["datastore_backend"] not in ("shelve", "journal"):
+			raise ConfigValidationError("datastore_backend", "value must be \"shelve\" or \"journal\"")
+		if "datastore_journal_path" in config and not isinstance(config["datastore_journal_path"], basestring):
+			raise ConfigValidationError("datastore_journal_path", "value must be a string")
+		if "datastore_thread_sync" in config:
+			if not isinstance(config["datastore_thread_sync"], bool):
+				raise ConfigValidationError("datastore_thread_sync", "value must be true or false")
+			if config["datastore_thread_sync"] and config.get("datastore_backend", "shelve") != "journal":
+				self.logConfigValidationWarning("datastore_thread_sync", "only supported by the journal datastore_backend", False)
+				config["datastore_thread_sync"] = False
 		if "storage_sync_interval" in config and not isinstance(config["storage_sync_interval"], int):
 			raise ConfigValidationError(config["storage_sync_interval"], "invalid number")
 
@@ -547,6 +622,14 @@ class IRCd(Service):
 			elif config["gecos_length"] < 1:
 				config["gecos_length"] = 1
 				self.logConfigValidationWarning("gecos_length", "value is too small", 1)
+		if "user_output_buffering" in config and not isinstance(config["user_output_buffering"], bool):
+			raise ConfigValidationError("user_output_buffering", "value must be true or false")
+		if "user_recvq_limit" in config and (not isinstance(config["user_recvq_limit"], int) or config["user_recvq_limit"] < 0):
+			raise ConfigValidationError("user_recvq_limit", "invalid number")
+		if "user_commands_per_tick" in config and (not isinstance(config["user_commands_per_tick"], int) or config["user_commands_per_tick"] < 1):
+			raise ConfigValidationError("user_commands_per_tick", "invalid number")
+		if "user_sendq_limit" in config and (not isinstance(config["user_sendq_limit"], int) or config["user_sendq_limit"] < 0):
+			raise ConfigValidationError("user_sendq_limit", "invalid number")
 		if "user_listmode_limit" in config:
 			if not isinstance(config["user_listmode_limit"], int) or config["user_listmode_limit"] < 0:
 				raise ConfigValidationError("user_listmode_limit", "invalid number")
@@ -563,6 +646,16 @@ class IRCd(Service):
 				self.logConfigValidationWarning("server_registration_timeout", "timeout could be too short for servers to register in time", 10)
 		if "server_ping_frequency" in config and (not isinstance(config["server_ping_frequency"], int) or config["server_ping_frequency"] < 0):
 			raise ConfigValidationError("server_ping_frequency", "invalid number")
+		if "server_output_buffering" in config and not isinstance(config["server_output_buffering"], bool):
+			raise ConfigValidationError("server_output_buffering", "value must be true or false")
+		
+		# Connections
+		if "output_buffer_high_water" in config:
+			if not isinstance(config["output_buffer_high_water"], int) or config["output_buffer_high_water"] < 0:
+				raise ConfigValidationError("output_buffer_high_water", "invalid number")
+			elif config["output_buffer_high_water"] < 512:
+				config["output_buffer_high_water"] = 512
+				self.logConfigValidationWarning("output_buffer_high_water", "value is too small", 512)
 
 		for module in self.loadedModules.itervalues():
 			module.verifyConfig(config)
@@ -589,6 +682,7 @@ class IRCd(Service):
 		
 		for module in self.loadedModules.itervalues():
 			module.rehash()
+		self._registrationInfoCache.clear()
 	
 	def _bindPorts(self):
 		for bindDesc in self.config["bind_client"]:
@@ -676,6 +770,86 @@ class IRCd(Service):
 		for channel in removeChannels:
 			del self.recentlyDestroyedChannels[channel]
 	
+	def scheduleUserCommands(self, user):
+		"""
+		Schedules processing of the commands a user has queued. Users with
+		queued commands are processed in turn, a limited number of commands
+		for each user per reactor iteration, so that no single connection can
+		keep the others from being serviced. Scheduling a user who is already
+		waiting to be processed does nothing.
+		"""
+		if user in self._commandQueueUserSet:
+			return
+		self._commandQueueUsers.append(user)
+		self._commandQueueUserSet.add(user)
+		if self._commandQueueCall is None:
+			self._commandQueueCall = reactor.callLater(0, self._processCommandQueues)
+	
+	def _processCommandQueues(self):
+		self._commandQueueCall = None
+		budget = self.config.get("user_commands_per_tick", 20)
+		for i in range(len(self._commandQueueUsers)): # Only process users queued before this round started
+			user = self._commandQueueUsers.popleft()
+			if user.processQueuedCommands(budget):
+				self._commandQueueUsers.append(user)
+			else:
+				self._commandQueueUserSet.discard(user)
+		if self._commandQueueUsers:
+			self._commandQueueCall = reactor.callLater(0, self._processCommandQueues)
+	
+	def scheduleExpiry(self, expireTime, callback, *args):
+		"""
+		Schedules a function to be called with the given arguments once the
+		given time (a UNIX timestamp) has passed. All scheduled expiries share
+		a single timer and are kept in a heap ordered by expiry time.
+		Returns a handle that can be passed to cancelExpiry.
+		"""
+		expiry = [expireTime, self._expirySequence.next(), callback, args]
+		heappush(self._expiryHeap, expiry)
+		if self._expiryHeap[0] is expiry:
+			self._scheduleExpiryCall()
+		return expiry
+	
+	def cancelExpiry(self, expiry):
+		"""
+		Cancels an expiry scheduled with scheduleExpiry. Cancelling an expiry
+		that has already run or been cancelled does nothing.
+		"""
+		if expiry[2] is None:
+			return
+		expiry[2] = None
+		expiry[3] = None
+		self._cancelledExpiryCount += 1
+		if self._cancelledExpiryCount > len(self._expiryHeap) / 2: # Don't let cancelled expiries build up
+			self._expiryHeap = [heapExpiry for heapExpiry in self._expiryHeap if heapExpiry[2] is not None]
+			heapify(self._expiryHeap)
+			self._cancelledExpiryCount = 0
+	
+	def _scheduleExpiryCall(self):
+		if self._expiryCall is not None and self._expiryCall.active():
+			self._expiryCall.cancel()
+		self._expiryCall = None
+		if self._expiryHeap:
+			self._expiryCall = reactor.callLater(max(0, self._expiryHeap[0][0] - time()), self._runExpiries)
+	
+	def _runExpiries(self):
+		self._expiryCall = None
+		currentTime = time()
+		while self._expiryHeap and self._expiryHeap[0][0] <= currentTime:
+			expiry = heappop(self._expiryHeap)
+			callback = expiry[2]
+			if callback is None:
+				self._cancelledExpiryCount -= 1
+				continue
+			args = expiry[3]
+			expiry[2] = None
+			expiry[3] = None
+			try:
+				callback(*args)
+			except Exception:
+				self.log.failure("An error occurred while running a scheduled expiry")
+		self._scheduleExpiryCall()
+	
 	def generateISupportList(self):
 		isupport = self.isupport_tokens.copy()
 		statusSymbolOrder = "".join([self.channelStatuses[status][0] for status in self.channelStatusOrder])
@@ -694,6 +868,51 @@ class IRCd(Service):
 				isupportList.append("{}={}".format(key, val))
 		return isupportList
 	
+	def getISupportLines(self):
+		"""
+		Returns the parameter lists for the RPL_ISUPPORT lines sent to users.
+		The lines are built once and reused until the server is rehashed or a
+		module is loaded or unloaded. Tokens are checked for illegal characters
+		here, so the lines can be sent as trusted parameters.
+		"""
+		if "isupport" not in self._registrationInfoCache:
+			isupportLines = []
+			isupportList = []
+			for token in self.generateISupportList():
+				if "\r" in token or "\n" in token or "\0" in token:
+					self.log.error("Not sending ISUPPORT token {token!r} because it contains illegal characters", token=token)
+				else:
+					isupportList.append(token)
+			for line in splitMessage(" ".join(isupportList), 350):
+				lineArgs = line.split(" ")
+				lineArgs.append("are supported by this server")
+				isupportLines.append(lineArgs)
+			self._registrationInfoCache["isupport"] = isupportLines
+		return self._registrationInfoCache["isupport"]
+	
+	def getModeLists(self):
+		"""
+		Returns a tuple of the user mode string and the channel mode string
+		(including statuses) sent in RPL_MYINFO. The strings are cached in the
+		same way as the ISUPPORT lines.
+		"""
+		if "modelists" not in self._registrationInfoCache:
+			userModes = "".join(["".join(modes.keys()) for modes in self.userModes])
+			chanModes = "".join(["".join(modes.keys()) for modes in self.channelModes])
+			chanModes += "".join(self.channelStatuses.keys())
+			self._registrationInfoCache["modelists"] = (userModes, chanModes)
+		return self._registrationInfoCache["modelists"]
+	
+	def getRegistrationInfo(self, key, buildFunction):
+		"""
+		Returns other data sent to users on registration (such as the MOTD),
+		calling buildFunction to build it if it isn't cached. The data is
+		cached in the same way as the ISUPPORT lines.
+		"""
+		if key not in self._registrationInfoCache:
+			self._registrationInfoCache[key] = buildFunction()
+		return self._registrationInfoCache[key]
+	
 	def connectServer(self, name):
 		"""
 		Connect a server with the given name in the configuration.
@@ -734,87 +953,87 @@ class IRCd(Service):
 			channels = kw["channels"]
 		
 		functionList = []
+		if not users and not channels:
+			return functionList
 		
+		userModePlan, channelModePlan = self._getActionPlan(actionName)
 		if users:
-			genericUserActionName = "modeactioncheck-user-{}".format(actionName)
-			genericUserActionNameWithChannel = "modeactioncheck-user-withchannel-{}".format(actionName)
-			for modeType in self.userModes:
-				for mode, modeObj in modeType.iteritems():
-					if actionName not in modeObj.affectedActions:
-						continue
-					priority = modeObj.affectedActions[actionName]
-					actionList = []
-					# Because Python doesn't properly capture variables in lambdas, we have to force static capture
-					# by wrapping lambdas in more lambdas.
-					# I wish Python wasn't this gross.
-					for action in self.actions.get("modeactioncheck-user", []):
-						actionList.append(((lambda action, actionName, mode: lambda user, *params: action[0](actionName, mode, user, *params))(action, actionName, mode), action[1]))
-					for action in self.actions.get("modeactioncheck-user-withchannel", []):
-						for channel in channels:
-							actionList.append(((lambda action, actionName, mode, channel: lambda user, *params: action[0](actionName, mode, user, channel, *params))(action, actionName, mode, channel), action[1]))
-					for action in self.actions.get(genericUserActionName, []):
-						actionList.append(((lambda action, mode: lambda user, *params: action[0](mode, user, *params))(action, mode), action[1]))
-					for action in self.actions.get(genericUserActionNameWithChannel, []):
-						for channel in channels:
-							actionList.append(((lambda action, mode, channel: lambda user, *params: action[0](mode, user, channel, *params))(action, mode, channel), action[1]))
-					modeUserActionName = "modeactioncheck-user-{}-{}".format(mode, actionName)
-					modeUserActionNameWithChannel = "modeactioncheck-user-withchannel-{}-{}".format(mode, actionName)
-					for action in self.actions.get(modeUserActionNameWithChannel, []):
-						for channel in channels:
-							actionList.append(((lambda action, channel: lambda user, *params: action[0](user, channel, *params))(action, channel), action[1]))
-					actionList = sorted(self.actions.get(modeUserActionName, []) + actionList, key=lambda action: action[1], reverse=True)
-					applyUsers = []
-					for user in users:
-						for action in actionList:
-							param = action[0](user, *params)
-							if param is not None:
-								if param is not False:
-									applyUsers.append((user, param))
-								break
-					for user, param in applyUsers:
-						functionList.append(((lambda modeObj, actionName, user, param: lambda *params: modeObj.apply(actionName, user, param, *params))(modeObj, actionName, user, param), priority))
-		
+			for mode, modeObj, priority, checkList in userModePlan:
+				for user in users:
+					param = self._checkModeAction(checkList, user, channels, params)
+					if param is not None and param is not False:
+						functionList.append((partial(modeObj.apply, actionName, user, param), priority))
 		if channels:
-			genericChannelActionName = "modeactioncheck-channel-{}".format(actionName)
-			genericChannelActionNameWithUser = "modeactioncheck-channel-withuser-{}".format(actionName)
-			for modeType in self.channelModes:
-				for mode, modeObj in modeType.iteritems():
-					if actionName not in modeObj.affectedActions:
-						continue
-					priority = modeObj.affectedActions[actionName]
-					actionList = []
-					for action in self.actions.get("modeactioncheck-channel", []):
-						actionList.append(((lambda action, actionName, mode: lambda channel, *params: action[0](actionName, mode, channel, *params))(action, actionName, mode), action[1]))
-					for action in self.actions.get("modeactioncheck-channel-withuser", []):
-						for user in users:
-							actionList.append(((lambda action, actionName, mode, user: lambda channel, *params: action[0](actionName, mode, channel, user, *params))(action, actionName, mode, user), action[1]))
-					for action in self.actions.get(genericChannelActionName, []):
-						actionList.append(((lambda action, mode: lambda channel, *params: action[0](mode, channel, *params))(action, mode), action[1]))
-					for action in self.actions.get(genericChannelActionNameWithUser, []):
-						for user in users:
-							actionList.append(((lambda action, mode, user: lambda channel, *params: action[0](mode, channel, user, *params))(action, mode, user), action[1]))
-					modeChannelActionName = "modeactioncheck-channel-{}-{}".format(mode, actionName)
-					modeChannelActionNameWithUser = "modeactioncheck-channel-withuser-{}-{}".format(mode, actionName)
-					for action in self.actions.get(modeChannelActionNameWithUser, []):
-						for user in users:
-							actionList.append(((lambda action, user: lambda channel, *params: action[0](channel, user, *params))(action, user), action[1]))
-					actionList = sorted(self.actions.get(modeChannelActionName, []) + actionList, key=lambda action: action[1], reverse=True)
-					applyChannels = []
-					for channel in channels:
-						for action in actionList:
-							param = action[0](channel, *params)
-							if param is not None:
-								if param is not False:
-									applyChannels.append((channel, param))
-								break
-					for channel, param in applyChannels:
-						functionList.append(((lambda modeObj, actionName, channel, param: lambda *params: modeObj.apply(actionName, channel, param, *params))(modeObj, actionName, channel, param), priority))
+			for mode, modeObj, priority, checkList in channelModePlan:
+				for channel in channels:
+					param = self._checkModeAction(checkList, channel, users, params)
+					if param is not None and param is not False:
+						functionList.append((partial(modeObj.apply, actionName, channel, param), priority))
 		return functionList
 	
+	def _getActionPlan(self, actionName):
+		"""
+		Gets the dispatch plan for the modes affecting an action. The plan is a
+		tuple of (userModePlan, channelModePlan), each of which is a list of
+		(mode, modeObj, priority, checkList) tuples. Plans are cached until
+		the set of loaded modules (and therefore modes and actions) changes.
+		"""
+		if actionName in self._actionPlanCache:
+			return self._actionPlanCache[actionName]
+		userModePlan = []
+		for mode, modeObj, priority in self._userModeActionIndex.get(actionName, []):
+			userModePlan.append((mode, modeObj, priority, self._buildModeCheckList("user", "channel", actionName, mode)))
+		channelModePlan = []
+		for mode, modeObj, priority in self._channelModeActionIndex.get(actionName, []):
+			channelModePlan.append((mode, modeObj, priority, self._buildModeCheckList("channel", "user", actionName, mode)))
+		plan = (userModePlan, channelModePlan)
+		self._actionPlanCache[actionName] = plan
+		return plan
+	
+	def _buildModeCheckList(self, targetType, otherType, actionName, mode):
+		"""
+		Builds the list of modeactioncheck handlers for a mode affecting an
+		action. Each entry is a tuple of
+		(function, priority, leadingParams, withOther)
+		where leadingParams are passed before the target and withOther
+		indicates whether the handler is called once per user or channel of
+		the other type, which follows the target in the parameter list.
+		"""
+		checkList = []
+		for action in self.actions.get("modeactioncheck-{}".format(targetType), []):
+			checkList.append((action[0], action[1], (actionName, mode), False))
+		for action in self.actions.get("modeactioncheck-{}-with{}".format(targetType, otherType), []):
+			checkList.append((action[0], action[1], (actionName, mode), True))
+		for action in self.actions.get("modeactioncheck-{}-{}".format(targetType, actionName), []):
+			checkList.append((action[0], action[1], (mode,), False))
+		for action in self.actions.get("modeactioncheck-{}-with{}-{}".format(targetType, otherType, actionName), []):
+			checkList.append((action[0], action[1], (mode,), True))
+		for action in self.actions.get("modeactioncheck-{}-with{}-{}-{}".format(targetType, otherType, mode, actionName), []):
+			checkList.append((action[0], action[1], (), True))
+		modeSpecificList = [(action[0], action[1], (), False) for action in self.actions.get("modeactioncheck-{}-{}-{}".format(targetType, mode, actionName), [])]
+		return sorted(modeSpecificList + checkList, key=lambda check: check[1], reverse=True)
+	
+	def _checkModeAction(self, checkList, target, others, params):
+		for checkFunc, priority, leadingParams, withOther in checkList:
+			if withOther:
+				for other in others:
+					param = checkFunc(*(leadingParams + (target, other) + params))
+					if param is not None:
+						return param
+			else:
+				param = checkFunc(*(leadingParams + (target,) + params))
+				if param is not None:
+					return param
+		return None
+	
 	def _getActionFunctionList(self, actionName, *params, **kw):
 		functionList = self.actions.get(actionName, [])
-		functionList = functionList + self._getActionModes(actionName, *params, **kw)
-		return sorted(functionList, key=lambda action: action[1], reverse=True)
+		if actionName not in self._userModeActionIndex and actionName not in self._channelModeActionIndex:
+			return functionList # No modes affect this action, so there's nothing to check
+		modeFunctionList = self._getActionModes(actionName, *params, **kw)
+		if not modeFunctionList:
+			return functionList # Action lists are replaced rather than modified when modules change, so this is safe to iterate
+		return sorted(functionList + modeFunctionList, key=lambda action: action[1], reverse=True)
 	
 	def _combineActionFunctionLists(self, actionLists):
 		"""
@@ -4,7 +4,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ircLower, now
 from zope.interface import implements
-from fnmatch import fnmatchcase
 
 class ELine(ModuleData, XLineBase):
 	implements(IPlugin, IModuleData)
@@ -29,18 +28,11 @@ class ELine(ModuleData, XLineBase):
 	def load(self):
 		self.initializeLineStorage()
 	
-	def checkUserMatch(self, user, mask, data):
-		exceptMask = ircLower(mask)
-		userMask = ircLower("{}@{}".format(user.ident, user.host()))
-		if fnmatchcase(userMask, exceptMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.realHost))
-		if fnmatchcase(userMask, exceptMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.ip))
-		if fnmatchcase(userMask, exceptMask):
-			return True
-		return False
+	def unload(self):
+		self.cancelLineExpiries()
+	
+	def userMatchStrings(self, user, data):
+		return [ircLower("{}@{}".format(user.ident, user.host())), ircLower("{}@{}".format(user.ident, user.realHost)), ircLower("{}@{}".format(user.ident, user.ip))]
 	
 	def checkException(self, lineType, user, mask, data):
 		if lineType == "E":
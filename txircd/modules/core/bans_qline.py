@@ -5,7 +5,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ircLower, now
 from zope.interface import implements
-from fnmatch import fnmatchcase
 
 class QLine(ModuleData, XLineBase):
 	implements(IPlugin, IModuleData)
@@ -32,14 +31,17 @@ class QLine(ModuleData, XLineBase):
 	def load(self):
 		self.initializeLineStorage()
 
+	def unload(self):
+		self.cancelLineExpiries()
+
 	def verifyConfig(self, config):
 		if "client_ban_msg" in config and not isinstance(config["client_ban_msg"], basestring):
 			raise ConfigValidationError("client_ban_msg", "value must be a string")
 	
-	def checkUserMatch(self, user, mask, data):
+	def userMatchStrings(self, user, data):
 		if data and "newnick" in data:
-			return fnmatchcase(ircLower(data["newnick"]), ircLower(mask))
-		return fnmatchcase(ircLower(user.nick), ircLower(mask))
+			return [ircLower(data["newnick"])]
+		return [ircLower(user.nick)]
 	
 	def changeNick(self, user, reason, hasBeenConnected):
 		self.ircd.log.info("Matched user {user.uuid} ({user.nick}) against a q:line: {reason}", user=user, reason=reason)
@@ -56,7 +58,6 @@ class QLine(ModuleData, XLineBase):
 		return True
 	
 	def checkNick(self, user, data):
-		self.expireLines()
 		newNick = data["nick"]
 		reason = self.matchUser(user, { "newnick": newNick })
 		if reason is not None:
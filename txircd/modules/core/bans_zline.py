@@ -3,9 +3,8 @@ from twisted.words.protocols import irc
 from txircd.config import ConfigValidationError
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
-from txircd.utils import durationToSeconds, now
+from txircd.utils import CIDRTree, durationToSeconds, formatCIDR, now, parseCIDR
 from zope.interface import implements
-from fnmatch import fnmatchcase
 import socket
 
 class ZLine(ModuleData, XLineBase):
@@ -31,14 +30,44 @@ class ZLine(ModuleData, XLineBase):
 	def load(self):
 		self.initializeLineStorage()
 
+	def unload(self):
+		self.cancelLineExpiries()
+
 	def verifyConfig(self, config):
 		if "client_ban_msg" in config and not isinstance(config["client_ban_msg"], basestring):
 			raise ConfigValidationError("client_ban_msg", "value must be a string")
 	
-	def checkUserMatch(self, user, mask, data):
-		return fnmatchcase(user.ip, mask)
+	def buildLineIndex(self):
+		self.cidrLines = CIDRTree()
+		XLineBase.buildLineIndex(self)
+	
+	def userMatchStrings(self, user, data):
+		return [user.ip.lower()]
+	
+	def indexSpecialMask(self, normalMask, sequence, lineData):
+		if "/" not in normalMask:
+			return False
+		try:
+			self.cidrLines.add(normalMask, (sequence, lineData))
+		except ValueError:
+			return False # An invalid CIDR mask is left to match only that exact string
+		return True
+	
+	def unindexSpecialMask(self, normalMask):
+		if "/" not in normalMask:
+			return False
+		return self.cidrLines.remove(normalMask)
+	
+	def findSpecialMatches(self, user, data, matchingLines):
+		for sequence, lineData in self.cidrLines.matches(user.ip):
+			matchingLines[sequence] = lineData
 	
 	def normalizeMask(self, mask):
+		if "/" in mask:
+			try:
+				return formatCIDR(*parseCIDR(mask))
+			except ValueError:
+				return mask.lower()
 		if ":" in mask and "*" not in mask and "?" not in mask: # Normalize non-wildcard IPv6 addresses
 			try:
 				return socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, mask)).lower()
@@ -77,6 +106,12 @@ class UserZLine(Command):
 		banmask = params[0]
 		if banmask in self.module.ircd.userNicks:
 			banmask = self.module.ircd.users[self.module.ircd.userNicks[banmask]].ip
+		elif "/" in banmask and len(params) > 1:
+			try:
+				parseCIDR(banmask)
+			except ValueError:
+				user.sendSingleError("ZLineParams", "NOTICE", "*** {} is not a valid CIDR mask.".format(banmask))
+				return None
 		if len(params) == 1:
 			return {
 				"mask": banmask
@@ -9,6 +9,48 @@ irc.RPL_BADWORDADDED = "927"
 irc.RPL_BADWORDREMOVED = "928"
 irc.ERR_NOSUCHBADWORD = "929"
 
+regexSpecialChars = set(".^$*+?{}[]\\|()")
+inlineFlagsRegex = re.compile(r"\(\?[iLmsux]")
+
+def literalWordPattern(words):
+	"""
+	Builds a regular expression matching any of the given literal words. Words
+	sharing a prefix share a branch of the expression, so the cost of matching
+	depends on the length of the words rather than on how many words there are.
+	"""
+	trie = {}
+	for word in words:
+		node = trie
+		for char in word:
+			node = node.setdefault(char, {})
+		node[""] = True
+	return _trieNodePattern(trie)
+
+def _trieNodePattern(node):
+	terminal = "" in node
+	branches = []
+	singleChars = []
+	for char in sorted(node.iterkeys()):
+		if not char:
+			continue
+		childPattern = _trieNodePattern(node[char])
+		if childPattern is None:
+			singleChars.append(re.escape(char))
+		else:
+			branches.append(re.escape(char) + childPattern)
+	if len(singleChars) == 1:
+		branches.append(singleChars[0])
+	elif singleChars:
+		branches.append("[{}]".format("".join(singleChars)))
+	if not branches:
+		return None
+	if len(branches) == 1 and not terminal:
+		return branches[0]
+	pattern = "(?:{})".format("|".join(branches))
+	if terminal:
+		pattern += "?"
+	return pattern
+
 class Censor(ModuleData):
 	implements(IPlugin, IModuleData)
 
@@ -70,6 +112,57 @@ class Censor(ModuleData):
 		if "badwords" not in self.ircd.storage:
 			self.ircd.storage["badwords"] = {}
 		self.badwords = self.ircd.storage["badwords"]
+		self.compileBadwords()
+
+	def compileBadwords(self):
+		"""
+		Compiles the badword list so that messages can be censored in one pass.
+		Literal badwords and badword patterns that can be combined are matched
+		by a single expression; patterns with groups or that can match an empty
+		string are applied separately.
+		"""
+		self.literalBadwords = {}
+		self.patternBadwords = []
+		self.separateBadwords = []
+		combinedPatterns = []
+		for mask, replacement in self.badwords.iteritems():
+			try:
+				compiledMask = re.compile(mask, re.IGNORECASE)
+			except re.error:
+				self.ircd.log.warn("Ignoring badword {mask} that isn't a valid regular expression", mask=mask)
+				continue
+			if compiledMask.groups or compiledMask.match("") is not None or inlineFlagsRegex.search(mask):
+				self.separateBadwords.append((compiledMask, replacement))
+			elif "\\" not in replacement and not regexSpecialChars.intersection(mask):
+				self.literalBadwords[mask.lower()] = replacement
+			else:
+				self.patternBadwords.append((compiledMask, replacement))
+				combinedPatterns.append("(?:{})".format(mask))
+		if self.literalBadwords:
+			combinedPatterns.insert(0, literalWordPattern(self.literalBadwords.iterkeys()))
+		if combinedPatterns:
+			self.badwordRegex = re.compile("|".join(combinedPatterns), re.IGNORECASE)
+		else:
+			self.badwordRegex = None
+
+	def censorMessage(self, message):
+		if self.badwordRegex is not None:
+			message = self.badwordRegex.sub(self.replaceBadword, message)
+		for compiledMask, replacement in self.separateBadwords:
+			message = compiledMask.sub(replacement, message)
+		return message
+
+	def replaceBadword(self, match):
+		matchedText = match.group()
+		lowerText = matchedText.lower()
+		if lowerText in self.literalBadwords:
+			return self.literalBadwords[lowerText]
+		# Literal words are tried first, so anything else was matched by the first pattern that matches here
+		for compiledMask, replacement in self.patternBadwords:
+			badwordMatch = compiledMask.match(match.string, match.start())
+			if badwordMatch is not None:
+				return badwordMatch.expand(replacement)
+		return matchedText
 
 class ChannelCensor(Mode):
 	implements(IMode)
@@ -87,10 +180,7 @@ class ChannelCensor(Mode):
 		if "targetchans" not in data:
 			return
 		if channel in data["targetchans"] and not self.ircd.runActionUntilValue("checkexemptchanops", "censor", channel, user):
-			message = data["targetchans"][channel]
-			for mask, replacement in self.censor.badwords.iteritems():
-				message = re.sub(mask, replacement, message, flags=re.IGNORECASE)
-			data["targetchans"][channel] = message
+			data["targetchans"][channel] = self.censor.censorMessage(data["targetchans"][channel])
 
 class UserCensor(Mode):
 	implements(IMode)
@@ -107,10 +197,7 @@ class UserCensor(Mode):
 		if "targetusers" not in data:
 			return
 		if targetUser in data["targetusers"]: 
-			message = data["targetusers"][targetUser]
-			for mask, replacement in self.censor.badwords.iteritems():
-				message = re.sub(mask, replacement, message, flags=re.IGNORECASE)
-			data["targetusers"][targetUser] = message
+			data["targetusers"][targetUser] = self.censor.censorMessage(data["targetusers"][targetUser])
 
 class UserCensorCommand(Command):
 	implements(ICommand)
@@ -129,6 +216,11 @@ class UserCensorCommand(Command):
 			}
 		else:
 			# Adding a badword
+			try:
+				re.compile(params[0])
+			except re.error:
+				user.sendSingleError("CensorCmd", "NOTICE", "*** {} is not a valid regular expression.".format(params[0]))
+				return None
 			return {
 				"badword": params[0],
 				"replacement": params[1]
@@ -140,6 +232,7 @@ class UserCensorCommand(Command):
 			replacement = data["replacement"]
 			self.censor.badwords[badword] = replacement
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.compileBadwords()
 			self.censor.propagateBadword(badword, replacement)
 			user.sendMessage(irc.RPL_BADWORDADDED, badword, replacement)
 		else:
@@ -148,6 +241,7 @@ class UserCensorCommand(Command):
 				return True
 			del self.censor.badwords[badword]
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.compileBadwords()
 			self.censor.propagateBadword(badword, None)
 			user.sendMessage(irc.RPL_BADWORDREMOVED, badword, "Badword removed")
 		return True
@@ -181,12 +275,14 @@ class ServerCensorCommand(Command):
 			replacement = data["replacement"]
 			self.censor.badwords[badword] = replacement
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.compileBadwords()
 			for remoteServer in self.censor.ircd.servers.itervalues():
 				if remoteServer.nextClosest == self.censor.ircd.serverID and remoteServer != server:
 					remoteServer.sendMessage("CENSOR", badword, replacement, prefix=self.censor.ircd.serverID)
 		else:
 			del self.censor.badwords[badword]
 			self.censor.ircd.storage["badwords"] = self.censor.badwords
+			self.censor.compileBadwords()
 			for remoteServer in self.censor.ircd.servers.itervalues():
 				if remoteServer.nextClosest == self.censor.ircd.serverID and remoteServer != server:
 					remoteServer.sendMessage("CENSOR", badword, prefix=self.censor.ircd.serverID)
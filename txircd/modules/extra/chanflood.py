@@ -1,14 +1,22 @@
 from twisted.plugin import IPlugin
+from twisted.words.protocols import irc
+from txircd.config import ConfigValidationError
 from txircd.module_interface import IMode, IModuleData, Mode, ModuleData
-from txircd.utils import ModeType, now
+from txircd.utils import ModeType
 from zope.interface import implements
-from datetime import timedelta
+from time import time
+from weakref import ref
+
+parsedParamCacheSize = 1024
+userFloodActions = ("kick", "ban", "mute")
 
 class ChannelFlood(ModuleData, Mode):
 	implements(IPlugin, IModuleData, IMode)
 	
 	name = "ChannelFlood"
 	affectedActions = {
+		"commandmodify-PRIVMSG": 10,
+		"commandmodify-NOTICE": 10,
 		"commandextra-PRIVMSG": 10,
 		"commandextra-NOTICE": 10
 	}
@@ -17,51 +25,153 @@ class ChannelFlood(ModuleData, Mode):
 		return [ ("f", ModeType.Param, self) ]
 	
 	def actions(self):
-		return [ ("modeactioncheck-channel-f-commandextra-PRIVMSG", 10, self.channelHasMode),
+		return [ ("modeactioncheck-channel-f-commandmodify-PRIVMSG", 10, self.channelHasMode),
+		         ("modeactioncheck-channel-f-commandmodify-NOTICE", 10, self.channelHasMode),
+		         ("modeactioncheck-channel-f-commandextra-PRIVMSG", 10, self.channelHasMode),
 		         ("modeactioncheck-channel-f-commandextra-NOTICE", 10, self.channelHasMode) ]
 	
+	def load(self):
+		self.parsedParams = {}
+	
+	def unload(self):
+		for channel in self.ircd.channels.itervalues():
+			if "floodunmoderate" in channel.cache:
+				self.ircd.cancelExpiry(channel.cache["floodunmoderate"])
+				del channel.cache["floodunmoderate"]
+	
+	def verifyConfig(self, config):
+		if "channel_flood_moderate_duration" in config and (not isinstance(config["channel_flood_moderate_duration"], int) or config["channel_flood_moderate_duration"] < 0):
+			raise ConfigValidationError("channel_flood_moderate_duration", "invalid number")
+	
 	def channelHasMode(self, channel, user, data):
 		if "f" in channel.modes:
 			return channel.modes["f"]
 		return None
 	
+	def parseParam(self, param):
+		"""
+		Parses a +f parameter into a tuple of (userLimit, channelLimit).
+		The userLimit is a tuple of (lines, seconds, action) for messages from
+		each user, and the channelLimit is a tuple of (lines, seconds) for
+		messages from all users in the channel. Either may be None if that
+		limit isn't set. Returns None if the parameter isn't valid.
+		"""
+		if param in self.parsedParams:
+			return self.parsedParams[param]
+		userLimit = None
+		channelLimit = None
+		for limit in param.split(","):
+			channelWide = limit.startswith("*")
+			if channelWide:
+				limit = limit[1:]
+			limitParts = limit.split(":")
+			if len(limitParts) == 3 and not channelWide:
+				action = limitParts.pop()
+				if action not in userFloodActions:
+					return None
+			elif len(limitParts) == 2:
+				action = "kick"
+			else:
+				return None
+			try:
+				lines = int(limitParts[0])
+				seconds = int(limitParts[1])
+			except ValueError:
+				return None
+			if lines < 1 or seconds < 1:
+				return None
+			if channelWide:
+				if channelLimit is not None:
+					return None
+				channelLimit = (lines, seconds)
+			else:
+				if userLimit is not None:
+					return None
+				userLimit = (lines, seconds, action)
+		if len(self.parsedParams) >= parsedParamCacheSize:
+			self.parsedParams.clear()
+		self.parsedParams[param] = (userLimit, channelLimit)
+		return userLimit, channelLimit
+	
 	def checkSet(self, channel, param):
-		if param.count(":") != 1:
-			return None
-		lines, seconds = param.split(":")
-		try:
-			lines = int(lines)
-			seconds = int(seconds)
-		except ValueError:
+		parsedParam = self.parseParam(param)
+		if parsedParam is None:
 			return None
-		if lines < 1 or seconds < 1:
-			return None
-		return [param]
+		userLimit, channelLimit = parsedParam
+		limits = []
+		if userLimit is not None:
+			if userLimit[2] == "kick":
+				limits.append("{}:{}".format(userLimit[0], userLimit[1]))
+			else:
+				limits.append("{}:{}:{}".format(*userLimit))
+		if channelLimit is not None:
+			limits.append("*{}:{}".format(*channelLimit))
+		return [",".join(limits)]
 	
 	def apply(self, actionName, channel, param, user, data):
 		if "targetchans" not in data or channel not in data["targetchans"]:
 			return
 		if self.ircd.runActionUntilValue("checkexemptchanops", "chanflood", channel, user):
-			return 
-		if "floodhistory" not in channel.users[user]:
-			channel.users[user]["floodhistory"] = []
-		
-		currentTime = now()
-		channel.users[user]["floodhistory"].append((data["targetchans"][channel], currentTime))
-		maxLines, seconds = param.split(":")
-		maxLines = int(maxLines)
-		seconds = int(seconds)
-		duration = timedelta(seconds=seconds)
-		floodTime = currentTime - duration
-		floodHistory = channel.users[user]["floodhistory"]
+			return
+		memberData = channel.users[user]
+		currentTime = time()
+		if actionName.startswith("commandmodify"):
+			if "floodmuted" in memberData:
+				if memberData["floodmuted"] > currentTime:
+					del data["targetchans"][channel]
+					user.sendMessage(irc.ERR_CANNOTSENDTOCHAN, channel.name, "Cannot send to channel (flood limit reached)")
+				else:
+					del memberData["floodmuted"]
+			return
 		
-		while floodHistory:
-			if floodHistory[0][1] <= floodTime:
-				del floodHistory[0]
-			else:
-				break
-		channel.users[user]["floodhistory"] = floodHistory
-		if len(floodHistory) > maxLines:
+		userLimit, channelLimit = self.parseParam(param)
+		if channelLimit is not None and self.takeToken(channel.cache, channelLimit[0], channelLimit[1], currentTime):
+			self.moderateChannel(channel)
+		if userLimit is not None and self.takeToken(memberData, userLimit[0], userLimit[1], currentTime):
+			lines, seconds, action = userLimit
+			if action == "mute":
+				memberData["floodmuted"] = currentTime + seconds
+				return
+			if action == "ban":
+				channel.setModes([(True, "b", "*!*@{}".format(user.host()))], self.ircd.serverID)
 			user.leaveChannel(channel, "KICK", { "byuser": False, "server": self.ircd, "reason": "Channel flood limit reached" })
+	
+	def takeToken(self, floodData, lines, seconds, currentTime):
+		"""
+		Counts a message against a token bucket that holds lines messages and
+		refills over the given number of seconds. The bucket is kept as
+		[tokens, lastTime] under "floodbucket" in floodData. Returns True if
+		the bucket has run out.
+		"""
+		if "floodbucket" not in floodData:
+			floodData["floodbucket"] = [lines - 1, currentTime]
+			return False
+		bucket = floodData["floodbucket"]
+		tokens = bucket[0] + (currentTime - bucket[1]) * lines / float(seconds)
+		if tokens > lines:
+			tokens = lines
+		tokens -= 1
+		bucket[0] = tokens
+		bucket[1] = currentTime
+		return tokens < 0
+	
+	def moderateChannel(self, channel):
+		if "m" in channel.modes:
+			return
+		channel.setModes([(True, "m", None)], self.ircd.serverID)
+		moderateDuration = self.ircd.config.get("channel_flood_moderate_duration", 60)
+		if moderateDuration and "m" in channel.modes:
+			if "floodunmoderate" in channel.cache:
+				self.ircd.cancelExpiry(channel.cache["floodunmoderate"])
+			channel.cache["floodunmoderate"] = self.ircd.scheduleExpiry(time() + moderateDuration, self.unmoderateChannel, ref(channel))
+	
+	def unmoderateChannel(self, channelRef):
+		# The channel is held weakly so that an emptied channel can still be destroyed
+		channel = channelRef()
+		if channel is None:
+			return
+		del channel.cache["floodunmoderate"]
+		if "m" in channel.modes:
+			channel.setModes([(False, "m", None)], self.ircd.serverID)
 
-chanFlood = ChannelFlood()
\ No newline at end of file
+chanFlood = ChannelFlood()
@@ -1,6 +1,7 @@
 from twisted.plugin import IPlugin
 from txircd.config import ConfigValidationError
 from txircd.module_interface import IModuleData, ModuleData
+from txircd.utils import CIDRTree, formatCIDR, parseCIDR
 from zope.interface import implements
 
 class ConnectionLimit(ModuleData):
@@ -16,6 +17,13 @@ class ConnectionLimit(ModuleData):
 		         ("remotequit", 100, self.handleDisconnect) ]
 
 	def load(self):
+		self.rehash()
+
+	def rehash(self):
+		self.whitelist = CIDRTree()
+		for mask in self.ircd.config.get("connlimit_whitelist", []):
+			self.whitelist.add(mask, True)
+		self.peerConnections = {}
 		for user in self.ircd.users.itervalues():
 			self.addToConnections(user.ip)
 
@@ -28,12 +36,20 @@ class ConnectionLimit(ModuleData):
 			for ip in config["connlimit_whitelist"]:
 				if not isinstance(ip, basestring):
 					raise ConfigValidationError("connlimit_whitelist", "every entry must be a valid ip")
+				try:
+					parseCIDR(ip)
+				except ValueError:
+					raise ConfigValidationError("connlimit_whitelist", "every entry must be a valid ip")
+		if "connlimit_ipv4_prefix" in config and (not isinstance(config["connlimit_ipv4_prefix"], int) or config["connlimit_ipv4_prefix"] < 0 or config["connlimit_ipv4_prefix"] > 32):
+			raise ConfigValidationError("connlimit_ipv4_prefix", "invalid number")
+		if "connlimit_ipv6_prefix" in config and (not isinstance(config["connlimit_ipv6_prefix"], int) or config["connlimit_ipv6_prefix"] < 0 or config["connlimit_ipv6_prefix"] > 128):
+			raise ConfigValidationError("connlimit_ipv6_prefix", "invalid number")
 
 	def handleLocalConnect(self, user, *params):
-		ip = user.ip
-		if self.addToConnections(ip) and self.peerConnections[ip] > self.ircd.config.get("connlimit_globmax", 3):
-			self.ircd.log.info("Connection limit reached from {ip}", ip=ip)
-			user.disconnect("No more connections allowed from your IP ({})".format(ip))
+		network = self.addToConnections(user.ip)
+		if network and self.peerConnections[network] > self.ircd.config.get("connlimit_globmax", 3):
+			self.ircd.log.info("Connection limit reached from {ip}", ip=network)
+			user.disconnect("No more connections allowed from your IP ({})".format(network))
 			return None
 		return True
 
@@ -41,19 +57,41 @@ class ConnectionLimit(ModuleData):
 		self.addToConnections(user.ip)
 
 	def handleDisconnect(self, user, *params):
-		ip = user.ip
-		if ip in self.peerConnections:
-			self.peerConnections[ip] -= 1
-			if self.peerConnections[ip] < 1:
-				del self.peerConnections[ip]
+		if self.whitelist.matches(user.ip):
+			return
+		network = self.connectionNetwork(user.ip)
+		if network in self.peerConnections:
+			self.peerConnections[network] -= 1
+			if self.peerConnections[network] < 1:
+				del self.peerConnections[network]
+
+	def connectionNetwork(self, ip):
+		"""
+		Returns the network connections from the given IP address are counted
+		toward: the IP address itself, or the network of the configured prefix
+		length containing it.
+		"""
+		try:
+			address, bits, bits = parseCIDR(ip)
+		except ValueError:
+			return ip
+		if bits == 32:
+			prefixLength = self.ircd.config.get("connlimit_ipv4_prefix", 32)
+		else:
+			prefixLength = self.ircd.config.get("connlimit_ipv6_prefix", 128)
+		if prefixLength == bits:
+			return ip
+		hostBits = bits - prefixLength
+		return formatCIDR(address >> hostBits << hostBits, prefixLength, bits)
 
 	def addToConnections(self, ip):
-		if ip in self.ircd.config.get("connlimit_whitelist", []):
-			return False
-		if ip in self.peerConnections:
-			self.peerConnections[ip] += 1
+		if self.whitelist.matches(ip):
+			return None
+		network = self.connectionNetwork(ip)
+		if network in self.peerConnections:
+			self.peerConnections[network] += 1
 		else:
-			self.peerConnections[ip] = 1
-		return True
+			self.peerConnections[network] = 1
+		return network
 
-connLimit = ConnectionLimit()
\ No newline at end of file
+connLimit = ConnectionLimit()
@@ -2,10 +2,9 @@ from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.config import ConfigValidationError
 from txircd.module_interface import Command, ICommand, IMode, IModuleData, Mode, ModuleData
-from txircd.utils import ModeType, now
+from txircd.utils import ModeType, nowTimestamp
 from zope.interface import implements
-from datetime import timedelta
-from weakref import WeakKeyDictionary
+from weakref import WeakKeyDictionary, ref
 
 irc.ERR_CANNOTKNOCK  = "480"
 irc.RPL_KNOCK = "710"
@@ -24,7 +23,8 @@ class Knock(ModuleData):
 	
 	def actions(self):
 		return [ ("modeactioncheck-channel-K-commandpermission-KNOCK", 10, self.channelHasMode),
-		         ("invite", 1, self.clearKnocksOnInvite) ]
+		         ("invite", 1, self.clearKnocksOnInvite),
+		         ("quit", 10, self.clearKnocksOnQuit) ]
 	
 	def userCommands(self):
 		return [ ("KNOCK", 1, UserKnock(self.ircd)) ]
@@ -32,6 +32,10 @@ class Knock(ModuleData):
 	def serverCommands(self):
 		return [ ("KNOCK", 1, ServerKnock(self.ircd)) ]
 	
+	def unload(self):
+		for user in self.ircd.users.itervalues():
+			self.clearKnocksOnQuit(user, None)
+	
 	def verifyConfig(self, config):
 		if "knock_delay" in config and (not isinstance(config["knock_delay"], int) or config["knock_delay"] < 0):
 			raise ConfigValidationError("knock_delay", "invalid number")
@@ -43,7 +47,16 @@ class Knock(ModuleData):
 	
 	def clearKnocksOnInvite(self, user, targetUser, channel):
 		if "knocks" in targetUser.cache and channel in targetUser.cache["knocks"]:
+			self.ircd.cancelExpiry(targetUser.cache["knocks"][channel])
 			del targetUser.cache["knocks"][channel]
+	
+	def clearKnocksOnQuit(self, user, reason):
+		# Also clears a user's knocks when the module is unloaded so that no expiry outlives it
+		if "knocks" not in user.cache:
+			return
+		for expiry in user.cache["knocks"].values():
+			self.ircd.cancelExpiry(expiry)
+		del user.cache["knocks"]
 
 class UserKnock(Command):
 	implements(ICommand)
@@ -65,7 +78,6 @@ class UserKnock(Command):
 	
 	def execute(self, user, data):
 		channel = data["channel"]
-		self.expireKnocks(user)
 		if user in channel.users:
 			user.sendMessage(irc.ERR_KNOCKONCHAN, channel.name, "Can't KNOCK on {}, you are already on that channel".format(channel.name))
 			return True
@@ -77,7 +89,7 @@ class UserKnock(Command):
 			return True
 		if "knocks" not in user.cache:
 			user.cache["knocks"] = WeakKeyDictionary()
-		user.cache["knocks"][channel] = now()
+		user.cache["knocks"][channel] = self.ircd.scheduleExpiry(nowTimestamp() + self.ircd.config.get("knock_delay", 300), self.expireKnock, user, ref(channel))
 		reason = data["reason"]
 		for targetUser in channel.users:
 			if targetUser.uuid[:3] == self.ircd.serverID and self.ircd.runActionUntilValue("checkchannellevel", "invite", channel, targetUser, users=[targetUser], channels=[channel]):
@@ -89,16 +101,10 @@ class UserKnock(Command):
 	def affectedChannels(self, user, data):
 		return [data["channel"]]
 	
-	def expireKnocks(self, user):
-		if "knocks" not in user.cache:
-			return
-		expiredKnocks = []
-		nowTime = now()
-		timeDiff = timedelta(seconds=self.ircd.config.get("knock_delay", 300))
-		for channel, knockTime in user.cache["knocks"].iteritems():
-			if knockTime + timeDiff < nowTime:
-				expiredKnocks.append(channel)
-		for channel in expiredKnocks:
+	def expireKnock(self, user, channelRef):
+		# The channel is held weakly so that a pending knock doesn't keep an empty channel alive
+		channel = channelRef()
+		if channel is not None and "knocks" in user.cache and channel in user.cache["knocks"]:
 			del user.cache["knocks"][channel]
 
 class ServerKnock(Command):
@@ -1,8 +1,8 @@
 from twisted.plugin import IPlugin
 from txircd.config import ConfigValidationError
 from txircd.module_interface import IModuleData, ModuleData
-from txircd.utils import now, timestamp
 from zope.interface import implements
+from time import time
 
 class RateLimit(ModuleData):
 	implements(IPlugin, IModuleData)
@@ -34,42 +34,100 @@ class RateLimit(ModuleData):
 		if "rate_interval" in config:
 			if not isinstance(config["rate_interval"], int) or config["rate_interval"] < 0:
 				raise ConfigValidationError("rate_interval", "invalid number")
+			if config["rate_interval"] == 0:
+				self.ircd.logConfigValidationWarning("rate_interval", "a value of 0 leaves no time to send commands", 1)
+				config["rate_interval"] = 1
 		else:
 			config["rate_interval"] = 60
+		
+		if "rate_command_costs" in config:
+			if not isinstance(config["rate_command_costs"], dict):
+				raise ConfigValidationError("rate_command_costs", "value must be a dictionary")
+			commandCosts = {}
+			for command, cost in config["rate_command_costs"].iteritems():
+				if not isinstance(command, basestring):
+					raise ConfigValidationError("rate_command_costs", "every command must be a string")
+				if not isinstance(cost, (int, float)) or cost < 0:
+					raise ConfigValidationError("rate_command_costs", "invalid cost for command {}".format(command))
+				commandCosts[command.upper()] = cost
+			config["rate_command_costs"] = commandCosts
+		else:
+			config["rate_command_costs"] = {}
+		
+		if "rate_limit_mode" in config:
+			if config["rate_limit_mode"] not in ("block", "throttle"):
+				raise ConfigValidationError("rate_limit_mode", "value must be \"block\" or \"throttle\"")
+		else:
+			config["rate_limit_mode"] = "block"
 
-	def getPeriodData(self):
-		"""Returns (period as integer, time to end of period)"""
-		nowTS = timestamp(now())
-		interval = self.ircd.config["rate_interval"]
-		period = int(nowTS / interval)
-		timeToEnd = (period + 1) * interval - nowTS
-		return period, timeToEnd
+	def userBudget(self, user):
+		"""
+		Returns (soft limit, kill limit) for the user. Other modules can give
+		users a different budget by returning such a tuple from the
+		ratelimitbudget action.
+		"""
+		budget = self.ircd.runActionUntilValue("ratelimitbudget", user, users=[user])
+		if budget:
+			return budget
+		return self.ircd.config["rate_soft_limit"], self.ircd.config["rate_kill_limit"]
+
+	def commandCost(self, command, data):
+		"""
+		Returns the cost of a command. Commands sent to several targets cost the
+		command's cost for each target.
+		"""
+		cost = self.ircd.config["rate_command_costs"].get(command, 1)
+		targetCount = len(data.get("targetusers", ())) + len(data.get("targetchans", ()))
+		if targetCount > 1:
+			cost *= targetCount
+		return cost
 
 	def recvCommand(self, user, command, data):
-		rateData = user.cache.setdefault("ratelimit-stats", {})
-		thisPeriod, timeToEnd = self.getPeriodData()
-		if rateData.get("period", None) != thisPeriod:
-			# reset stats after each period
-			rateData["messages"] = 0
-			rateData["period"] = thisPeriod
-			rateData["noticeSent"] = False
-		killLimit = self.ircd.config["rate_kill_limit"]
-		rateData["messages"] += 1
-		if rateData["messages"] > killLimit:
-			user.disconnect("Killed: Flooding")
-			return False
-		softLimit = self.ircd.config["rate_soft_limit"]
-		if rateData["messages"] > softLimit:
-			# only send notice once per period
-			if not rateData["noticeSent"]:
+		softLimit, killLimit = self.userBudget(user)
+		interval = self.ircd.config["rate_interval"]
+		refillRate = softLimit / float(interval)
+		cost = min(self.commandCost(command, data), softLimit)
+		currentTime = time()
+		# The bucket is [tokens, last update time, whether the user has been notified]
+		if "ratelimit-bucket" not in user.cache:
+			user.cache["ratelimit-bucket"] = [softLimit, currentTime, False]
+		rateData = user.cache["ratelimit-bucket"]
+		tokens = rateData[0] + (currentTime - rateData[1]) * refillRate
+		if tokens > softLimit:
+			tokens = softLimit
+		rateData[1] = currentTime
+		if tokens >= cost:
+			# only notify the user again once they've recovered a real part of their budget
+			if rateData[2] and tokens >= softLimit / 2.0:
+				rateData[2] = False
+			rateData[0] = tokens - cost
+			return None
+		# we whitelist ping/pong to prevent ping timeouts
+		whitelisted = command in ("PING", "PONG")
+		if self.ircd.config["rate_limit_mode"] == "throttle" and not whitelisted:
+			rateData[0] = tokens
+			if not rateData[2]:
 				user.sendMessage("NOTICE", ("You are sending too many messages (limit is {limit}/{interval:.2f}s). "
-				                            "You cannot send any more messages for {timeToEnd:.2f} seconds."
-				                           ).format(limit=softLimit, interval=self.ircd.config["rate_interval"], timeToEnd=timeToEnd))
+				                            "Your commands will be processed more slowly."
+				                           ).format(limit=softLimit, interval=interval))
 				self.ircd.log.info("User {user.uuid} ({user.nick}) exceeded the message limit", user=user)
-				rateData["noticeSent"] = True
-			# we whitelist ping/pong to prevent ping timeouts
-			if command not in ("PING", "PONG"):
-				return False
-		return None
+				rateData[2] = True
+			user.delayCommands((cost - tokens) / refillRate, True)
+			return False
+		tokens -= cost
+		rateData[0] = tokens
+		if tokens < softLimit - killLimit:
+			user.disconnect("Killed: Flooding")
+			return False
+		# only send notice once until the user is back under the limit
+		if not rateData[2]:
+			user.sendMessage("NOTICE", ("You are sending too many messages (limit is {limit}/{interval:.2f}s). "
+			                            "You cannot send any more messages for {timeToEnd:.2f} seconds."
+			                           ).format(limit=softLimit, interval=interval, timeToEnd=(1 - tokens) / refillRate))
+			self.ircd.log.info("User {user.uuid} ({user.nick}) exceeded the message limit", user=user)
+			rateData[2] = True
+		if whitelisted:
+			return None
+		return False
 
-rateLimit = RateLimit()
\ No newline at end of file
+rateLimit = RateLimit()
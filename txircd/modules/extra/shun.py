@@ -5,7 +5,6 @@ from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.modules.xlinebase import XLineBase
 from txircd.utils import durationToSeconds, ircLower, now
 from zope.interface import implements
-from fnmatch import fnmatchcase
 
 class Shun(ModuleData, XLineBase):
 	implements(IPlugin, IModuleData)
@@ -32,6 +31,9 @@ class Shun(ModuleData, XLineBase):
 	def load(self):
 		self.initializeLineStorage()
 
+	def unload(self):
+		self.cancelLineExpiries()
+
 	def verifyConfig(self, config):
 		if "shun_commands" in config:
 			if not isinstance(config["shun_commands"], list):
@@ -40,18 +42,8 @@ class Shun(ModuleData, XLineBase):
 				if not isinstance(command, basestring):
 					raise ConfigValidationError("shun_commands", "\"{}\" is not a valid command".format(command))
 	
-	def checkUserMatch(self, user, mask, data):
-		banMask = self.normalizeMask(mask)
-		userMask = ircLower("{}@{}".format(user.ident, user.host()))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.realHost))
-		if fnmatchcase(userMask, banMask):
-			return True
-		userMask = ircLower("{}@{}".format(user.ident, user.ip))
-		if fnmatchcase(userMask, banMask):
-			return True
-		return False
+	def userMatchStrings(self, user, data):
+		return [ircLower("{}@{}".format(user.ident, user.host())), ircLower("{}@{}".format(user.ident, user.realHost)), ircLower("{}@{}".format(user.ident, user.ip))]
 	
 	def checkLines(self, user):
 		if self.matchUser(user) is not None:
@@ -46,6 +46,7 @@ class Batch(ModuleData):
 	def addBatchTag(self, user, command, args, kw):
 		if "currentBatch" in user.cache:
 			if "tags" in kw:
+				kw["tags"] = kw["tags"].copy() # The tags may be shared with other recipients
 				kw["tags"]["batch"] = user.cache["currentBatch"]
 			else:
 				kw["tags"] = { "batch": user.cache["currentBatch"] }
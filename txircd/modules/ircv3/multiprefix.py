@@ -9,7 +9,8 @@ class MultiPrefix(ModuleData):
 	
 	def actions(self):
 		return [ ("channelstatuses", 2, self.allStatuses),
-		         ("capabilitylist", 10, self.addCapability) ]
+		         ("capabilitylist", 10, self.addCapability),
+		         ("namesviewerclass", 10, self.addViewerClass) ]
 	
 	def load(self):
 		if "unloading-multi-prefix" in self.ircd.dataCache:
@@ -29,6 +30,10 @@ class MultiPrefix(ModuleData):
 	def addCapability(self, user, capList):
 		capList.append("multi-prefix")
 	
+	def addViewerClass(self, channel, user, viewerClass):
+		if "capabilities" in user.cache and "multi-prefix" in user.cache["capabilities"]:
+			viewerClass.append("multi-prefix")
+	
 	def allStatuses(self, channel, user, requestingUser):
 		if "capabilities" not in requestingUser.cache or "multi-prefix" not in requestingUser.cache["capabilities"]:
 			return None
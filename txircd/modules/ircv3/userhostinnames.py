@@ -9,7 +9,8 @@ class UserhostInNames(ModuleData):
 	
 	def actions(self):
 		return [ ("capabilitylist", 10, self.addCapability),
-		         ("displaychanneluser", 10, self.showUserHostmask) ]
+		         ("displaychanneluser", 10, self.showUserHostmask),
+		         ("namesviewerclass", 10, self.addViewerClass) ]
 	
 	def load(self):
 		if "unloading-userhost-in-names" in self.ircd.dataCache:
@@ -29,6 +30,10 @@ class UserhostInNames(ModuleData):
 	def addCapability(self, user, capList):
 		capList.append("userhost-in-names")
 	
+	def addViewerClass(self, channel, user, viewerClass):
+		if "capabilities" in user.cache and "userhost-in-names" in user.cache["capabilities"]:
+			viewerClass.append("userhost-in-names")
+	
 	def showUserHostmask(self, channel, showToUser, showingUser):
 		if "capabilities" not in showToUser.cache or "userhost-in-names" not in showToUser.cache["capabilities"]:
 			return None
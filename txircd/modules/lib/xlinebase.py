@@ -1,5 +1,14 @@
-from txircd.utils import ircLower, now, timestamp
-from datetime import datetime, timedelta
+from txircd.utils import ircLower, nowTimestamp, timestamp
+from datetime import datetime
+from fnmatch import translate
+from itertools import count
+import re
+
+# Wildcard masks with at least this many literal characters at the start or
+# end are grouped by those characters so that only the masks that could match
+# a given string are tried against it.
+indexKeyLength = 4
+wildcardChars = re.compile(r"[*?[\]]")
 
 class XLineBase(object):
 	lineType = None
@@ -10,40 +19,172 @@ class XLineBase(object):
 			self.ircd.storage["xlines"] = {}
 		if self.lineType not in self.ircd.storage["xlines"]:
 			self.ircd.storage["xlines"][self.lineType] = []
-		self.expireLines()
+			self.ircd.storage.markDirty("xlines", self.lineType)
+		self.buildLineIndex()
+	
+	def buildLineIndex(self):
+		"""
+		Builds the in-memory index of this type's lines from storage. Masks
+		without wildcards are kept in a dictionary for exact lookups, and
+		wildcard masks are compiled and grouped by their literal prefix or
+		suffix. Expiring lines are scheduled to be removed when they expire.
+		"""
+		self.cancelLineExpiries()
+		self._lineSequence = count()
+		self._indexedLines = {}
+		self._exactLines = {}
+		self._prefixLines = {}
+		self._suffixLines = {}
+		self._otherLines = {}
+		if not self.lineType:
+			return
+		for lineData in self.ircd.storage["xlines"][self.lineType]:
+			self._indexLine(lineData)
+	
+	def _indexLine(self, lineData):
+		normalMask = self.normalizeMask(lineData["mask"])
+		if normalMask in self._indexedLines:
+			return
+		sequence = self._lineSequence.next()
+		expiry = None
+		if lineData["duration"]:
+			expiry = self.ircd.scheduleExpiry(timestamp(lineData["created"]) + lineData["duration"], self._expireLine, normalMask, sequence)
+		self._indexedLines[normalMask] = (sequence, lineData, expiry)
+		if self.indexSpecialMask(normalMask, sequence, lineData):
+			return
+		wildcardMatch = wildcardChars.search(normalMask)
+		if not wildcardMatch:
+			self._exactLines[normalMask] = (sequence, lineData)
+		else:
+			matcher = re.compile(translate(normalMask)).match
+			prefix = normalMask[:wildcardMatch.start()]
+			suffix = wildcardChars.split(normalMask)[-1]
+			if len(prefix) >= indexKeyLength:
+				self._prefixLines.setdefault(prefix[:indexKeyLength], {})[normalMask] = (sequence, lineData, matcher)
+			elif len(suffix) >= indexKeyLength:
+				self._suffixLines.setdefault(suffix[-indexKeyLength:], {})[normalMask] = (sequence, lineData, matcher)
+			else:
+				self._otherLines[normalMask] = (sequence, lineData, matcher)
+	
+	def _unindexLine(self, normalMask):
+		if normalMask not in self._indexedLines:
+			return
+		expiry = self._indexedLines.pop(normalMask)[2]
+		if expiry is not None:
+			self.ircd.cancelExpiry(expiry)
+		if self.unindexSpecialMask(normalMask):
+			return
+		wildcardMatch = wildcardChars.search(normalMask)
+		if not wildcardMatch:
+			del self._exactLines[normalMask]
+			return
+		prefix = normalMask[:wildcardMatch.start()]
+		suffix = wildcardChars.split(normalMask)[-1]
+		if len(prefix) >= indexKeyLength:
+			lineGroups = self._prefixLines
+			groupKey = prefix[:indexKeyLength]
+		elif len(suffix) >= indexKeyLength:
+			lineGroups = self._suffixLines
+			groupKey = suffix[-indexKeyLength:]
+		else:
+			del self._otherLines[normalMask]
+			return
+		del lineGroups[groupKey][normalMask]
+		if not lineGroups[groupKey]:
+			del lineGroups[groupKey]
 	
 	def matchUser(self, user, data = None):
 		if not self.lineType:
 			return None
 		if user.uuid[:3] != self.ircd.serverID:
 			return None # The remote server should handle the users on that server
-		self.expireLines()
-		for lineData in self.ircd.storage["xlines"][self.lineType]:
+		for lineData in self.findMatchingLines(user, data):
 			mask = lineData["mask"]
-			if self.checkUserMatch(user, mask, data) and self.ircd.runComboActionUntilValue((("verifyxlinematch-{}".format(self.lineType), user, mask, data), ("verifyxlinematch", self.lineType, user, mask, data)), users=[user]) is not False:
+			if self.ircd.runComboActionUntilValue((("verifyxlinematch-{}".format(self.lineType), user, mask, data), ("verifyxlinematch", self.lineType, user, mask, data)), users=[user]) is not False:
 				return lineData["reason"]
 		return None
 	
+	def findMatchingLines(self, user, data):
+		"""
+		Returns the data of all lines matching the user, in the order in which
+		they were added.
+		"""
+		matchStrings = self.userMatchStrings(user, data)
+		if matchStrings is None: # The line type doesn't support indexed matching, so check each line
+			return [lineData for lineData in self.ircd.storage["xlines"][self.lineType] if self.checkUserMatch(user, lineData["mask"], data)]
+		matchingLines = {}
+		self.findSpecialMatches(user, data, matchingLines)
+		for matchString in matchStrings:
+			if matchString in self._exactLines:
+				sequence, lineData = self._exactLines[matchString]
+				matchingLines[sequence] = lineData
+			candidateGroups = [self._otherLines]
+			if len(matchString) >= indexKeyLength:
+				prefixKey = matchString[:indexKeyLength]
+				if prefixKey in self._prefixLines:
+					candidateGroups.append(self._prefixLines[prefixKey])
+				suffixKey = matchString[-indexKeyLength:]
+				if suffixKey in self._suffixLines:
+					candidateGroups.append(self._suffixLines[suffixKey])
+			for lineGroup in candidateGroups:
+				for sequence, lineData, matcher in lineGroup.itervalues():
+					if sequence not in matchingLines and matcher(matchString):
+						matchingLines[sequence] = lineData
+		return [matchingLines[sequence] for sequence in sorted(matchingLines)]
+	
+	def userMatchStrings(self, user, data):
+		"""
+		Returns a list of strings for the user, normalized in the same way as
+		masks, that a line matches when its mask matches any of them. Line
+		types that can't be matched this way should return None and implement
+		checkUserMatch instead.
+		"""
+		return None
+	
 	def checkUserMatch(self, user, mask, data):
 		pass
 	
+	def indexSpecialMask(self, normalMask, sequence, lineData):
+		"""
+		Allows a line type to index masks that aren't plain wildcard masks
+		itself. Returns whether the mask was indexed; if not, the mask is
+		indexed as a wildcard mask.
+		"""
+		return False
+	
+	def unindexSpecialMask(self, normalMask):
+		"""
+		Removes a mask indexed by indexSpecialMask. Returns whether the mask was
+		handled.
+		"""
+		return False
+	
+	def findSpecialMatches(self, user, data, matchingLines):
+		"""
+		Adds the lines indexed by indexSpecialMask that match the user to the
+		matchingLines dictionary, which maps the sequence number of each line
+		to its data.
+		"""
+		pass
+	
 	def addLine(self, mask, createdTime, durationSeconds, setter, reason, fromServer = None):
 		if not self.lineType:
 			return False
-		self.expireLines()
+		if durationSeconds and timestamp(createdTime) + durationSeconds < nowTimestamp():
+			return False # The line has already expired
 		normalMask = self.normalizeMask(mask)
-		lines = self.ircd.storage["xlines"][self.lineType]
-		for lineData in lines:
-			lineMask = self.normalizeMask(lineData["mask"])
-			if normalMask == lineMask:
-				return False
-		lines.append({
+		if normalMask in self._indexedLines:
+			return False
+		lineData = {
 			"mask": mask,
 			"created": createdTime,
 			"duration": durationSeconds,
 			"setter": setter,
 			"reason": reason
-		})
+		}
+		self.ircd.storage["xlines"][self.lineType].append(lineData)
+		self.ircd.storage.markDirty("xlines", self.lineType)
+		self._indexLine(lineData)
 		if self.propagateToServers:
 			self.ircd.broadcastToServers(fromServer, "ADDLINE", self.lineType, mask, setter, str(timestamp(createdTime)), str(durationSeconds), reason, prefix=self.ircd.serverID)
 		return True
@@ -52,39 +193,41 @@ class XLineBase(object):
 		if not self.lineType:
 			return False
 		normalMask = self.normalizeMask(mask)
-		for index, lineData in enumerate(self.ircd.storage["xlines"][self.lineType]):
-			lineMask = self.normalizeMask(lineData["mask"])
-			if normalMask == lineMask:
-				del self.ircd.storage["xlines"][self.lineType][index]
-				if self.propagateToServers:
-					self.ircd.broadcastToServers(fromServer, "DELLINE", self.lineType, mask)
-				return True
-		return False
+		if normalMask not in self._indexedLines:
+			return False
+		self._removeLine(normalMask)
+		if self.propagateToServers:
+			self.ircd.broadcastToServers(fromServer, "DELLINE", self.lineType, mask)
+		return True
+	
+	def _removeLine(self, normalMask):
+		lineData = self._indexedLines[normalMask][1]
+		self._unindexLine(normalMask)
+		self.ircd.storage["xlines"][self.lineType].remove(lineData)
+		self.ircd.storage.markDirty("xlines", self.lineType)
 	
 	def normalizeMask(self, mask):
 		return ircLower(mask)
 	
-	def expireLines(self):
-		if not self.lineType:
+	def _expireLine(self, normalMask, sequence):
+		if normalMask not in self._indexedLines or self._indexedLines[normalMask][0] != sequence:
+			return
+		self._removeLine(normalMask)
+	
+	def cancelLineExpiries(self):
+		"""
+		Cancels the scheduled expiry of all of this type's lines. Line types
+		should call this when unloaded.
+		"""
+		if not hasattr(self, "_indexedLines"):
 			return
-		currentTime = now()
-		expiredLines = []
-		lines = self.ircd.storage["xlines"][self.lineType]
-		for lineData in lines:
-			durationSeconds = lineData["duration"]
-			if not durationSeconds:
-				continue
-			duration = timedelta(seconds=lineData["duration"])
-			expireTime = lineData["created"] + duration
-			if expireTime < currentTime:
-				expiredLines.append(lineData)
-		for lineData in expiredLines:
-			lines.remove(lineData)
+		for sequence, lineData, expiry in self._indexedLines.itervalues():
+			if expiry is not None:
+				self.ircd.cancelExpiry(expiry)
 	
 	def generateInfo(self):
 		if not self.lineType:
 			return None
-		self.expireLines()
 		lineInfo = {}
 		for lineData in self.ircd.storage["xlines"][self.lineType]:
 			lineInfo[lineData["mask"]] = "{} {} {} :{}".format(timestamp(lineData["created"]), lineData["duration"], lineData["setter"], lineData["reason"])
@@ -128,7 +271,6 @@ class XLineBase(object):
 	def burstLines(self, server):
 		if not self.lineType:
 			return
-		self.expireLines()
 		if self.propagateToServers:
 			for lineData in self.ircd.storage["xlines"][self.lineType]:
 				server.sendMessage("ADDLINE", self.lineType, lineData["mask"], lineData["setter"], str(timestamp(lineData["created"])), str(lineData["duration"]), lineData["reason"], prefix=self.ircd.serverID)
\ No newline at end of file
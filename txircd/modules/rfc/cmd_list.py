@@ -1,9 +1,18 @@
+from twisted.internet import reactor
+from twisted.internet.task import TaskStopped, cooperate, deferLater
 from twisted.plugin import IPlugin
+from twisted.python.failure import Failure
 from twisted.words.protocols import irc
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
-from txircd.utils import ircLower
+from txircd.utils import ircLower, now
 from zope.interface import implements
-from fnmatch import fnmatchcase
+from datetime import timedelta
+from fnmatch import translate
+import re
+
+# While more than this many bytes are waiting to be sent to the user, LIST output waits
+listSendQThreshold = 32768
+listSendQWaitInterval = 0.1
 
 class ListCommand(ModuleData, Command):
 	implements(IPlugin, IModuleData, ICommand)
@@ -11,49 +20,191 @@ class ListCommand(ModuleData, Command):
 	name = "ListCommand"
 	core = True
 	
+	def actions(self):
+		return [ ("join", 10, self.addChannelUser),
+		         ("remotejoin", 10, self.addChannelUser),
+		         ("leave", 10, self.removeChannelUser),
+		         ("remoteleave", 10, self.removeChannelUser),
+		         ("buildisupport", 1, self.buildISupport) ]
+	
 	def userCommands(self):
 		return [ ("LIST", 1, self) ]
 	
+	def load(self):
+		# Channels with users, bucketed by user count
+		self.channelsByUserCount = {}
+		for channel in self.ircd.channels.itervalues():
+			if channel.users:
+				self.channelsByUserCount.setdefault(len(channel.users), set()).add(channel)
+	
+	def unload(self):
+		for user in self.ircd.users.itervalues():
+			if "listtask" in user.cache:
+				user.cache["listtask"].stop()
+	
+	def buildISupport(self, data):
+		data["ELIST"] = "CMNTU"
+	
+	def moveChannel(self, channel, oldCount, newCount):
+		if oldCount in self.channelsByUserCount:
+			countChannels = self.channelsByUserCount[oldCount]
+			countChannels.discard(channel)
+			if not countChannels:
+				del self.channelsByUserCount[oldCount]
+		if newCount:
+			self.channelsByUserCount.setdefault(newCount, set()).add(channel)
+	
+	def addChannelUser(self, channel, user):
+		# The user has already been added to the channel
+		userCount = len(channel.users)
+		self.moveChannel(channel, userCount - 1, userCount)
+	
+	def removeChannelUser(self, channel, user):
+		# The user hasn't been removed from the channel yet
+		userCount = len(channel.users)
+		self.moveChannel(channel, userCount, userCount - 1)
+	
 	def parseParams(self, user, params, prefix, tags):
 		if not params:
 			return {}
-		channels = []
-		wildcardNames = []
+		channelNames = set()
+		masks = []
+		negatedMasks = []
+		filters = {}
 		for name in params[0].split(","):
-			if "*" not in name and "?" not in name:
-				if name in self.ircd.channels:
-					channels.append(self.ircd.channels[name])
+			if not name:
+				continue
+			if name[0] in "<>":
+				filterType = name[0]
+			elif len(name) > 2 and name[0] in "CcTt" and name[1] in "<>":
+				filterType = name[:2].upper()
 			else:
-				wildcardNames.append(ircLower(name))
-		for lowerName, channel in self.ircd.channels.iteritems():
-			for wildcardName in wildcardNames:
-				if fnmatchcase(lowerName, wildcardName):
-					channels.append(channel)
-					break
-		return {
-			"channels": channels
-		}
+				filterType = None
+			if filterType:
+				try:
+					filterValue = int(name[len(filterType):])
+				except ValueError:
+					continue
+				if filterValue >= 0:
+					filters[filterType] = filterValue
+			elif name[0] == "!":
+				negatedMasks.append(translate(ircLower(name[1:])))
+			elif "*" in name or "?" in name:
+				masks.append(translate(ircLower(name)))
+			else:
+				channelNames.add(ircLower(name))
+		currentTime = now()
+		data = {}
+		if channelNames:
+			data["channelnames"] = channelNames
+		if masks:
+			data["mask"] = re.compile("|".join(masks))
+		if negatedMasks:
+			data["negatedmask"] = re.compile("|".join(negatedMasks))
+		if ">" in filters:
+			data["minusers"] = filters[">"]
+		if "<" in filters:
+			data["maxusers"] = filters["<"]
+		# Times are given in minutes; "C>n" means the channel was created more than n minutes ago
+		if "C>" in filters:
+			data["createdbefore"] = currentTime - timedelta(minutes=filters["C>"])
+		if "C<" in filters:
+			data["createdafter"] = currentTime - timedelta(minutes=filters["C<"])
+		if "T>" in filters:
+			data["topicbefore"] = currentTime - timedelta(minutes=filters["T>"])
+		if "T<" in filters:
+			data["topicafter"] = currentTime - timedelta(minutes=filters["T<"])
+		if channelNames or masks or negatedMasks:
+			data["searched"] = True # Filters alone don't search for channels by name
+		return data
 	
 	def execute(self, user, data):
-		if "channels" in data:
-			channels = data["channels"]
-			usedSearchMask = True
+		if "listtask" in user.cache:
+			user.cache["listtask"].stop()
+			user.sendMessage(irc.RPL_LISTEND, "End of channel list")
+		
+		# Only channel names are kept while the list is sent so that channels emptied in the meantime can still be destroyed
+		if "channelnames" in data and "mask" not in data:
+			channelNames = list(data["channelnames"])
+		elif "minusers" in data:
+			minUsers = data["minusers"]
+			channelNames = [channel.name for userCount, countChannels in self.channelsByUserCount.iteritems() if userCount > minUsers for channel in countChannels]
 		else:
-			channels = self.ircd.channels.values()
-			usedSearchMask = False
+			channelNames = self.ircd.channels.keys()
 		
 		user.sendMessage(irc.RPL_LISTSTART, "Channel", "Users Name")
-		for channel in channels:
-			displayData = {
-				"name": channel.name,
-				"usercount": len(channel.users),
-				"modestopic": "[{}] {}".format(channel.modeString(user), channel.topic)
-			}
-			self.ircd.runActionProcessing("displaychannel", displayData, channel, user, usedSearchMask, users=[user], channels=[channel])
-			if "name" not in displayData or "usercount" not in displayData or "modestopic" not in displayData:
-				continue
-			user.sendMessage(irc.RPL_LIST, displayData["name"], str(displayData["usercount"]), displayData["modestopic"])
-		user.sendMessage(irc.RPL_LISTEND, "End of channel list")
+		listTask = cooperate(self.listChannels(user, channelNames, data))
+		user.cache["listtask"] = listTask
+		listTask.whenDone().addBoth(self.finishList, user, listTask)
+		return True
+	
+	def finishList(self, result, user, listTask):
+		if user.cache.get("listtask") is listTask:
+			del user.cache["listtask"]
+		if isinstance(result, Failure):
+			result.trap(TaskStopped) # A stopped list was replaced by another one or the module was unloaded
+	
+	def channelMatches(self, channel, data):
+		"""
+		Checks a channel against the names, masks, and filters given to LIST.
+		"""
+		if "channelnames" in data or "mask" in data or "negatedmask" in data:
+			lowerName = ircLower(channel.name)
+			if "channelnames" in data or "mask" in data:
+				if lowerName not in data.get("channelnames", ()) and ("mask" not in data or not data["mask"].match(lowerName)):
+					return False
+			if "negatedmask" in data and data["negatedmask"].match(lowerName):
+				return False
+		userCount = len(channel.users)
+		if "minusers" in data and userCount <= data["minusers"]:
+			return False
+		if "maxusers" in data and userCount >= data["maxusers"]:
+			return False
+		if "createdbefore" in data and channel.existedSince > data["createdbefore"]:
+			return False
+		if "createdafter" in data and channel.existedSince < data["createdafter"]:
+			return False
+		if "topicbefore" in data or "topicafter" in data:
+			if not channel.topic:
+				return False
+			if "topicbefore" in data and channel.topicTime > data["topicbefore"]:
+				return False
+			if "topicafter" in data and channel.topicTime < data["topicafter"]:
+				return False
 		return True
+	
+	def listChannels(self, user, channelNames, data):
+		"""
+		Sends the list of channels to the user, one channel per step of the
+		cooperative task so that a large list is spread across reactor
+		iterations. Output waits while the user's send queue is full.
+		"""
+		usedSearchMask = "searched" in data
+		for channelName in channelNames:
+			while user.sendQueueSize() > listSendQThreshold:
+				yield deferLater(reactor, listSendQWaitInterval, lambda: None)
+				if user.uuid not in self.ircd.users:
+					return
+			if user.uuid not in self.ircd.users:
+				return
+			self.sendChannel(user, channelName, data, usedSearchMask)
+			yield None
+		user.sendMessage(irc.RPL_LISTEND, "End of channel list")
+	
+	def sendChannel(self, user, channelName, data, usedSearchMask):
+		channel = self.ircd.channels.get(channelName)
+		if channel is None:
+			return # The channel was destroyed after the list was started
+		if not self.channelMatches(channel, data):
+			return
+		displayData = {
+			"name": channel.name,
+			"usercount": len(channel.users),
+			"modestopic": "[{}] {}".format(channel.modeString(user), channel.topic)
+		}
+		self.ircd.runActionProcessing("displaychannel", displayData, channel, user, usedSearchMask, users=[user], channels=[channel])
+		if "name" not in displayData or "usercount" not in displayData or "modestopic" not in displayData:
+			return
+		user.sendMessage(irc.RPL_LIST, displayData["name"], str(displayData["usercount"]), displayData["modestopic"])
 
-listCmd = ListCommand()
\ No newline at end of file
+listCmd = ListCommand()
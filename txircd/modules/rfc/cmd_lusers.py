@@ -2,7 +2,6 @@ from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from zope.interface import implements
-from collections import defaultdict
 
 irc.RPL_LOCALUSERS = "265"
 irc.RPL_GLOBALUSERS = "266"
@@ -14,44 +13,89 @@ class LUsersCommand(ModuleData, Command):
 	core = True
 	
 	def actions(self):
-		return [ ("welcome", 6, lambda user: self.execute(user, {})) ]
+		return [ ("welcome", 100, self.addUser),
+		         ("remoteregister", 100, self.addUser),
+		         ("localregister", 100, self.addUser),
+		         ("quit", 100, self.removeUser),
+		         ("remotequit", 100, self.removeUser),
+		         ("localquit", 100, self.removeUser),
+		         ("modechanges-user", 100, self.updateUserModes),
+		         ("welcome", 6, lambda user: self.execute(user, {})) ]
 	
 	def userCommands(self):
 		return [ ("LUSERS", 1, self) ]
-
+	
+	def load(self):
+		self.userCounts = {
+			"users": 0,
+			"invisible": 0,
+			"opers": 0,
+			"local": 0
+		}
+		for user in self.ircd.users.itervalues():
+			if "lusers-counted" in user.cache:
+				del user.cache["lusers-counted"]
+			if user.isRegistered():
+				self.addUser(user)
+	
 	def getStorage(self):
 		if "user_count_max" not in self.ircd.storage:
 			self.ircd.storage["user_count_max"] = {}
 		return self.ircd.storage["user_count_max"]
 	
-	def updateMaxCounts(self, counts):
+	def updateMaxCounts(self):
 		maxes = self.getStorage()
 		for key in ("users", "local"):
-			if counts[key] > maxes.get(key, 0):
-				maxes[key] = counts[key]
-		return maxes
+			if self.userCounts[key] > maxes.get(key, 0):
+				maxes[key] = self.userCounts[key]
+				self.ircd.storage.markDirty("user_count_max", key)
+	
+	def changeCounts(self, user, change):
+		self.userCounts["users"] += change
+		if user.uuid[:3] == self.ircd.serverID:
+			self.userCounts["local"] += change
+		if "i" in user.modes:
+			self.userCounts["invisible"] += change
+		if "o" in user.modes:
+			self.userCounts["opers"] += change
+	
+	def addUser(self, user):
+		if "lusers-counted" in user.cache:
+			return
+		user.cache["lusers-counted"] = True
+		self.changeCounts(user, 1)
+		self.updateMaxCounts()
+	
+	def removeUser(self, user, reason):
+		if "lusers-counted" not in user.cache:
+			return
+		del user.cache["lusers-counted"]
+		self.changeCounts(user, -1)
+	
+	def updateUserModes(self, user, source, sourceName, modeChanges):
+		if "lusers-counted" not in user.cache:
+			return
+		for adding, mode, param, setBy, setTime in modeChanges:
+			if mode == "i":
+				self.userCounts["invisible"] += 1 if adding else -1
+			elif mode == "o":
+				self.userCounts["opers"] += 1 if adding else -1
 	
 	def countStats(self):
-		counts = defaultdict(lambda: 0)
-		counts["users"] = len(self.ircd.users)
+		"""
+		Returns a snapshot of the user counts and the maximum user counts.
+		The user counts are kept up to date as users connect, quit, and change
+		modes, so this doesn't need to look at every user.
+		"""
+		counts = self.userCounts.copy()
 		counts["servers"] = len(self.ircd.servers) + 1
 		counts["channels"] = len(self.ircd.channels)
-
-		for user in self.ircd.users.itervalues():
-			if "i" in user.modes:
-				counts["invisible"] += 1
-			if "o" in user.modes:
-				counts["opers"] += 1
-			if user.uuid[:3] == self.ircd.serverID:
-				counts["local"] += 1
-
+		counts["localservers"] = 0
 		for server in self.ircd.servers.itervalues():
 			if server.nextClosest == self.ircd.serverID:
 				counts["localservers"] += 1
-
 		counts["visible"] = counts["users"] - counts["invisible"]
-		maxes = self.updateMaxCounts(counts)
-		return counts, maxes
+		return counts, dict(self.getStorage())
 	
 	def parseParams(self, user, params, prefix, tags):
 		return {}
@@ -62,8 +106,8 @@ class LUsersCommand(ModuleData, Command):
 		user.sendMessage(irc.RPL_LUSEROP, str(counts["opers"]), "operator{} online".format("" if counts["opers"] == 1 else "s"))
 		user.sendMessage(irc.RPL_LUSERCHANNELS, str(counts["channels"]), "channel{} formed".format("" if counts["channels"] == 1 else "s"))
 		user.sendMessage(irc.RPL_LUSERME, "I have {counts[local]} clients and {counts[localservers]} servers".format(counts=counts))
-		user.sendMessage(irc.RPL_LOCALUSERS, "Current Local Users: {}  Max: {}".format(counts["local"], maxes["local"]))
-		user.sendMessage(irc.RPL_GLOBALUSERS, "Current Global Users: {}  Max: {}".format(counts["users"], maxes["users"]))
+		user.sendMessage(irc.RPL_LOCALUSERS, "Current Local Users: {}  Max: {}".format(counts["local"], maxes.get("local", 0)))
+		user.sendMessage(irc.RPL_GLOBALUSERS, "Current Global Users: {}  Max: {}".format(counts["users"], maxes.get("users", 0)))
 		return True
 
 lusersCmd = LUsersCommand()
\ No newline at end of file
@@ -34,6 +34,7 @@ class MessageOfTheDay(ModuleData, Command):
 		try:
 			with open(self.ircd.config["motd_file"], "r") as motdFile:
 				for line in motdFile:
+					line = line.replace("\r", "").replace("\0", "") # Checked here so the lines can be sent as trusted parameters
 					for outputLine in splitMessage(line, 400):
 						self.motd.append(outputLine)
 		except KeyError:
@@ -42,14 +43,21 @@ class MessageOfTheDay(ModuleData, Command):
 			self.ircd.log.error("Failed to open MOTD file") # But if a file was specified but couldn't be opened, we'll log an error
 		self.ircd.broadcastToServers(None, "INVALIDATEMOTD", prefix=self.ircd.serverID)
 	
-	def showMOTD(self, user):
+	def buildMOTDMessages(self):
+		"""
+		Builds the list of (command, params) messages that show the local MOTD.
+		"""
 		if not self.motd:
-			user.sendMessage(irc.ERR_NOMOTD, "Message of the day file is missing.")
-		else:
-			user.sendMessage(irc.RPL_MOTDSTART, "{} Message of the Day".format(self.ircd.name))
-			for line in self.motd:
-				user.sendMessage(irc.RPL_MOTD, line)
-			user.sendMessage(irc.RPL_ENDOFMOTD, "End of message of the day")
+			return [ (irc.ERR_NOMOTD, ("Message of the day file is missing.",)) ]
+		motdMessages = [ (irc.RPL_MOTDSTART, ("{} Message of the Day".format(self.ircd.name),)) ]
+		for line in self.motd:
+			motdMessages.append((irc.RPL_MOTD, (line,)))
+		motdMessages.append((irc.RPL_ENDOFMOTD, ("End of message of the day",)))
+		return motdMessages
+	
+	def showMOTD(self, user):
+		for command, params in self.ircd.getRegistrationInfo("motd", self.buildMOTDMessages):
+			user.sendMessage(command, *params, trusted=True)
 	
 	def showRemoteMOTD(self, user, server):
 		if server.serverID not in self.remoteMOTD:
@@ -1,9 +1,13 @@
 from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
-from txircd.utils import splitMessage
+from txircd.utils import ModeType
 from zope.interface import implements
 
+namesLineLength = 300
+# Actions whose results make up a user's entry in a NAMES reply
+namesActions = frozenset(("showchanneluser", "displaychanneluser", "channelstatuses"))
+
 class NamesCommand(ModuleData, Command):
 	implements(IPlugin, IModuleData, ICommand)
 	
@@ -14,7 +18,23 @@ class NamesCommand(ModuleData, Command):
 		return [ ("NAMES", 1, self) ]
 	
 	def actions(self):
-		return [ ("join", 2, self.namesOnJoin) ]
+		return [ ("join", 100, self.clearChannelLines),
+		         ("remotejoin", 100, self.clearChannelLines),
+		         ("join", 2, self.namesOnJoin),
+		         ("leave", 100, self.clearChannelUser),
+		         ("remoteleave", 100, self.clearChannelUser),
+		         ("changenick", 100, self.clearUser),
+		         ("remotechangenick", 100, self.clearUser),
+		         ("changeident", 100, self.clearUser),
+		         ("remotechangeident", 100, self.clearUser),
+		         ("changehost", 100, self.clearUser),
+		         ("modechanges-channel", 100, self.checkChannelModeChanges),
+		         ("modechanges-user", 100, self.checkUserModeChanges),
+		         ("moduleload", 100, self.clearAllChannels),
+		         ("moduleunload", 100, self.clearAllChannels) ]
+	
+	def unload(self):
+		self.clearAllChannels()
 	
 	def namesOnJoin(self, channel, user):
 		self.execute(user, { "channels": [ channel ] })
@@ -37,19 +57,113 @@ class NamesCommand(ModuleData, Command):
 			user.sendMessage(irc.RPL_ENDOFNAMES, "*", "End of /NAMES list")
 			return True
 		for channel in chanList:
-			showChannelUsers = []
-			for chanUser in channel.users.iterkeys():
-				if self.ircd.runActionUntilValue("showchanneluser", channel, user, chanUser, users=[user, chanUser], channels=[channel]) is False:
-					continue
-				showAs = self.ircd.runActionUntilValue("displaychanneluser", channel, user, chanUser, users=[chanUser], channels=[channel])
-				if not showAs:
-					showAs = chanUser.nick
-				showChannelUsers.append("{}{}".format(self.ircd.runActionUntilValue("channelstatuses", channel, chanUser, user, users=[chanUser, user], channels=[channel]), showAs))
-			if showChannelUsers:
-				userLines = splitMessage(" ".join(showChannelUsers), 300)
-				for line in userLines:
-					user.sendMessage(irc.RPL_NAMREPLY, "=", channel.name, line)
+			for line in self.namesLines(channel, user):
+				user.sendMessage(irc.RPL_NAMREPLY, "=", channel.name, line)
 			user.sendMessage(irc.RPL_ENDOFNAMES, channel.name, "End of /NAMES list")
 		return True
+	
+	def viewerClass(self, channel, user):
+		"""
+		Returns the class of the user viewing the channel's NAMES list. All
+		users in the same class see the same list. Modules that change the
+		list based on who's viewing it add to the class in the
+		namesviewerclass action.
+		"""
+		viewerClass = ["member" if user in channel.users else "nonmember"]
+		self.ircd.runActionStandard("namesviewerclass", channel, user, viewerClass, users=[user], channels=[channel])
+		return tuple(viewerClass)
+	
+	def namesLines(self, channel, user):
+		"""
+		Returns the lines of a channel's NAMES reply as shown to the given
+		user. Each user's entry and the joined lines are cached in the
+		channel for each viewer class, so only entries that have changed since
+		the last request are built again.
+		"""
+		viewerClass = self.viewerClass(channel, user)
+		if "nameslines" not in channel.cache:
+			channel.cache["nameslines"] = {}
+		elif viewerClass in channel.cache["nameslines"]:
+			return channel.cache["nameslines"][viewerClass]
+		if "namesentries" not in channel.cache:
+			channel.cache["namesentries"] = {}
+		if viewerClass not in channel.cache["namesentries"]:
+			channel.cache["namesentries"][viewerClass] = {}
+		entries = channel.cache["namesentries"][viewerClass]
+		
+		lines = []
+		lineEntries = []
+		lineLength = -1
+		for chanUser in channel.users.iterkeys():
+			if chanUser in entries:
+				entry = entries[chanUser]
+			else:
+				entry = self.userEntry(channel, user, chanUser)
+				entries[chanUser] = entry
+			if entry is None:
+				continue
+			if lineEntries and lineLength + len(entry) + 1 > namesLineLength:
+				lines.append(" ".join(lineEntries))
+				lineEntries = []
+				lineLength = -1
+			lineEntries.append(entry)
+			lineLength += len(entry) + 1
+		if lineEntries:
+			lines.append(" ".join(lineEntries))
+		channel.cache["nameslines"][viewerClass] = lines
+		return lines
+	
+	def userEntry(self, channel, user, chanUser):
+		"""
+		Builds the entry for chanUser in the channel's NAMES reply as shown to
+		user. Returns None if chanUser isn't shown.
+		"""
+		if self.ircd.runActionUntilValue("showchanneluser", channel, user, chanUser, users=[user, chanUser], channels=[channel]) is False:
+			return None
+		showAs = self.ircd.runActionUntilValue("displaychanneluser", channel, user, chanUser, users=[chanUser], channels=[channel])
+		if not showAs:
+			showAs = chanUser.nick
+		return "{}{}".format(self.ircd.runActionUntilValue("channelstatuses", channel, chanUser, user, users=[chanUser, user], channels=[channel]), showAs)
+	
+	def clearChannelLines(self, channel, *params):
+		if "nameslines" in channel.cache:
+			del channel.cache["nameslines"]
+	
+	def clearChannelUser(self, channel, user, *params):
+		if "namesentries" in channel.cache:
+			for entries in channel.cache["namesentries"].itervalues():
+				if user in entries:
+					del entries[user]
+		self.clearChannelLines(channel)
+	
+	def clearChannel(self, channel):
+		if "namesentries" in channel.cache:
+			del channel.cache["namesentries"]
+		self.clearChannelLines(channel)
+	
+	def clearUser(self, user, *params):
+		for channel in user.channels:
+			self.clearChannelUser(channel, user)
+	
+	def clearAllChannels(self, *params):
+		for channel in self.ircd.channels.itervalues():
+			self.clearChannel(channel)
+	
+	def checkChannelModeChanges(self, channel, source, sourceName, modeChanges):
+		for adding, mode, param, setBy, setTime in modeChanges:
+			modeType = self.ircd.channelModeTypes.get(mode, None)
+			if modeType == ModeType.Status:
+				if param in self.ircd.users:
+					self.clearChannelUser(channel, self.ircd.users[param])
+			elif modeType is not None and namesActions.intersection(self.ircd.channelModes[modeType][mode].affectedActions):
+				self.clearChannel(channel)
+				return
+	
+	def checkUserModeChanges(self, user, source, sourceName, modeChanges):
+		for adding, mode, param, setBy, setTime in modeChanges:
+			modeType = self.ircd.userModeTypes.get(mode, None)
+			if modeType is not None and namesActions.intersection(self.ircd.userModes[modeType][mode].affectedActions):
+				self.clearUser(user)
+				return
 
-namesCmd = NamesCommand()
\ No newline at end of file
+namesCmd = NamesCommand()
@@ -15,6 +15,10 @@ class StatsCommand(ModuleData, Command):
 	name = "StatsCommand"
 	core = True
 	
+	def actions(self):
+		return [ ("statsruntype-sendq", 1, self.listSendQ),
+		         ("statsruntype-storage", 1, self.listStorage) ]
+	
 	def userCommands(self):
 		return [ ("STATS", 1, UserStats(self.ircd)) ]
 	
@@ -30,6 +34,29 @@ class StatsCommand(ModuleData, Command):
 			for info in config["public_info"]:
 				if not isinstance(info, basestring):
 					raise ConfigValidationError("public_info", "every entry must be a string")
+	
+	def listSendQ(self):
+		sendQInfo = {}
+		for user in self.ircd.users.itervalues():
+			if user.uuid[:3] != self.ircd.serverID or not user.isRegistered():
+				continue
+			sendQSize = user.sendQueueSize()
+			if sendQSize:
+				sendQInfo[user.nick] = str(sendQSize)
+		return sendQInfo
+	
+	def listStorage(self):
+		storage = self.ircd.storage
+		storageInfo = {
+			"backend": storage.backendName,
+			"syncs": str(storage.syncCount),
+			"last-sync-ms": str(int(storage.lastSyncDuration * 1000)),
+			"last-sync-prepare-ms": str(int(storage.lastSyncPrepareDuration * 1000))
+		}
+		if storage.lastSyncBytes is not None:
+			storageInfo["last-sync-bytes"] = str(storage.lastSyncBytes)
+			storageInfo["total-sync-bytes"] = str(storage.totalSyncBytes)
+		return storageInfo
 
 class UserStats(Command):
 	implements(ICommand)
@@ -3,7 +3,10 @@ from twisted.words.protocols import irc
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
 from txircd.utils import ircLower
 from zope.interface import implements
-from fnmatch import fnmatchcase
+from fnmatch import fnmatchcase, translate
+import re
+
+indexKeyLength = 3
 
 class WhoCommand(ModuleData, Command):
 	implements(IPlugin, IModuleData, ICommand)
@@ -11,9 +14,115 @@ class WhoCommand(ModuleData, Command):
 	name = "WhoCommand"
 	core = True
 	
+	def actions(self):
+		return [ ("welcome", 100, self.indexUser),
+		         ("remoteregister", 100, self.indexUser),
+		         ("localregister", 100, self.indexUser),
+		         ("changenick", 100, self.reindexUser),
+		         ("remotechangenick", 100, self.reindexUser),
+		         ("changehost", 100, self.reindexUser),
+		         ("changegecos", 100, self.reindexUser),
+		         ("remotechangegecos", 100, self.reindexUser),
+		         ("quit", 100, self.unindexUser),
+		         ("remotequit", 100, self.unindexUser),
+		         ("localquit", 100, self.unindexUser) ]
+	
 	def userCommands(self):
 		return [ ("WHO", 1, self) ]
 	
+	def load(self):
+		# The fields indexed for each user are the lowered nick, host, and gecos, in that order.
+		self.userFields = {}
+		self.exactIndex = ({}, {}, {})
+		self.prefixIndex = tuple(tuple({} for keyLength in xrange(indexKeyLength)) for fieldIndex in xrange(3))
+		self.suffixIndex = tuple(tuple({} for keyLength in xrange(indexKeyLength)) for fieldIndex in xrange(3))
+		self.serverUsers = {}
+		for user in self.ircd.users.itervalues():
+			if user.isRegistered():
+				self.indexUser(user)
+	
+	def indexUser(self, user):
+		"""
+		Adds a user to the indices used to find users matching WHO masks.
+		Users are indexed by the exact value of each field and by the first and
+		last few characters of each field, so that masks starting or ending with
+		literal text only need to check the users in one index entry.
+		"""
+		uuid = user.uuid
+		fields = (ircLower(user.nick), ircLower(user.host()), ircLower(user.gecos))
+		self.userFields[uuid] = fields
+		for fieldIndex, value in enumerate(fields):
+			self._addToIndex(self.exactIndex[fieldIndex], value, uuid)
+			for keyLength in xrange(1, min(len(value), indexKeyLength) + 1):
+				self._addToIndex(self.prefixIndex[fieldIndex][keyLength - 1], value[:keyLength], uuid)
+				self._addToIndex(self.suffixIndex[fieldIndex][keyLength - 1], value[-keyLength:], uuid)
+		self._addToIndex(self.serverUsers, uuid[:3], uuid)
+	
+	def unindexUser(self, user, *params):
+		uuid = user.uuid
+		if uuid not in self.userFields:
+			return
+		fields = self.userFields.pop(uuid)
+		for fieldIndex, value in enumerate(fields):
+			self._removeFromIndex(self.exactIndex[fieldIndex], value, uuid)
+			for keyLength in xrange(1, min(len(value), indexKeyLength) + 1):
+				self._removeFromIndex(self.prefixIndex[fieldIndex][keyLength - 1], value[:keyLength], uuid)
+				self._removeFromIndex(self.suffixIndex[fieldIndex][keyLength - 1], value[-keyLength:], uuid)
+		self._removeFromIndex(self.serverUsers, uuid[:3], uuid)
+	
+	def reindexUser(self, user, *params):
+		if user.uuid not in self.userFields:
+			return # Unregistered users aren't indexed
+		self.unindexUser(user)
+		self.indexUser(user)
+	
+	def _addToIndex(self, index, key, uuid):
+		if key not in index:
+			index[key] = set()
+		index[key].add(uuid)
+	
+	def _removeFromIndex(self, index, key, uuid):
+		index[key].discard(uuid)
+		if not index[key]:
+			del index[key]
+	
+	def findMatchingUsers(self, lowerMask):
+		"""
+		Returns the set of UUIDs of registered users whose nick, host, gecos, or
+		server name matches the given lowered mask.
+		"""
+		matches = set()
+		for serverID, serverUUIDs in self.serverUsers.iteritems():
+			serverName = self.ircd.name if serverID == self.ircd.serverID else self.ircd.servers[serverID].name
+			if fnmatchcase(ircLower(serverName), lowerMask):
+				matches.update(serverUUIDs)
+		wildcardPositions = [position for position, char in enumerate(lowerMask) if char in "*?"]
+		if not wildcardPositions:
+			for exactIndex in self.exactIndex:
+				if lowerMask in exactIndex:
+					matches.update(exactIndex[lowerMask])
+			return matches
+		# Lowering the mask replaces any brackets, so * and ? are the only wildcards left
+		matchMask = re.compile(translate(lowerMask)).match
+		prefix = lowerMask[:wildcardPositions[0]]
+		suffix = lowerMask[wildcardPositions[-1] + 1:]
+		if prefix or suffix:
+			for fieldIndex in xrange(3):
+				if len(prefix) >= len(suffix):
+					keyLength = min(len(prefix), indexKeyLength)
+					candidates = self.prefixIndex[fieldIndex][keyLength - 1].get(prefix[:keyLength], ())
+				else:
+					keyLength = min(len(suffix), indexKeyLength)
+					candidates = self.suffixIndex[fieldIndex][keyLength - 1].get(suffix[-keyLength:], ())
+				for uuid in candidates:
+					if uuid not in matches and matchMask(self.userFields[uuid][fieldIndex]):
+						matches.add(uuid)
+			return matches
+		for uuid, fields in self.userFields.iteritems():
+			if uuid not in matches and (matchMask(fields[0]) or matchMask(fields[1]) or matchMask(fields[2])):
+				matches.add(uuid)
+		return matches
+	
 	def parseParams(self, user, params, prefix, tags):
 		if not params:
 			return {
@@ -33,10 +142,11 @@ class WhoCommand(ModuleData, Command):
 		channel = None
 		mask = data["mask"]
 		if mask in ("0", "*"):
+			userChannels = set(user.channels)
 			for targetUser in self.ircd.users.itervalues():
 				if not targetUser.isRegistered():
 					continue
-				if not set(user.channels).intersection(targetUser.channels) and self.ircd.runActionUntilValue("showuser", user, targetUser, users=[user, targetUser]) is not False:
+				if userChannels.isdisjoint(targetUser.channels) and self.ircd.runActionUntilValue("showuser", user, targetUser, users=[user, targetUser]) is not False:
 					matchingUsers.append(targetUser)
 		elif mask in self.ircd.channels:
 			channel = self.ircd.channels[data["mask"]]
@@ -44,14 +154,9 @@ class WhoCommand(ModuleData, Command):
 				if self.ircd.runActionUntilValue("showchanneluser", channel, user, targetUser, users=[user, targetUser], channels=[channel]) is not False:
 					matchingUsers.append(targetUser)
 		else:
-			for targetUser in self.ircd.users.itervalues():
-				if not targetUser.isRegistered():
-					continue # We should exclude all unregistered users from this search
-				if self.ircd.runActionUntilValue("showuser", user, targetUser, users=[user, targetUser]) is False:
-					continue
-				lowerMask = ircLower(mask)
-				serverName = self.ircd.name if targetUser.uuid[:3] == self.ircd.serverID else self.ircd.servers[targetUser.uuid[:3]].name
-				if fnmatchcase(ircLower(targetUser.host()), lowerMask) or fnmatchcase(ircLower(targetUser.gecos), lowerMask) or fnmatchcase(ircLower(serverName), lowerMask) or fnmatchcase(ircLower(targetUser.nick), lowerMask):
+			for uuid in self.findMatchingUsers(ircLower(mask)):
+				targetUser = self.ircd.users[uuid]
+				if self.ircd.runActionUntilValue("showuser", user, targetUser, users=[user, targetUser]) is not False:
 					matchingUsers.append(targetUser)
 		if "opersonly" in data:
 			allMatches = matchingUsers
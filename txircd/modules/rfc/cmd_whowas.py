@@ -2,8 +2,9 @@ from twisted.plugin import IPlugin
 from twisted.words.protocols import irc
 from txircd.config import ConfigValidationError
 from txircd.module_interface import Command, ICommand, IModuleData, ModuleData
-from txircd.utils import durationToSeconds, ircLower, now, timestamp
+from txircd.utils import durationToSeconds, ircLower, nowTimestamp
 from zope.interface import implements
+from collections import Counter, deque
 from datetime import datetime
 
 class WhowasCommand(ModuleData, Command):
@@ -23,49 +24,154 @@ class WhowasCommand(ModuleData, Command):
 	def load(self):
 		if "whowas" not in self.ircd.storage:
 			self.ircd.storage["whowas"] = {}
+		self.historyExpiry = None
+		self.loadHistory()
+		self.trimHistory()
+		self.scheduleHistoryExpiry()
+	
+	def unload(self):
+		if self.historyExpiry is not None:
+			self.ircd.cancelExpiry(self.historyExpiry)
+			self.historyExpiry = None
+	
+	def rehash(self):
+		for lowerNick in self.ircd.storage["whowas"].keys():
+			self.trimNickEntries(lowerNick)
+		self.trimHistory()
+		self.compactHistory()
+		self.scheduleHistoryExpiry()
 
 	def verifyConfig(self, config):
 		if "whowas_duration" in config and not isinstance(config["whowas_duration"], basestring) and not isinstance(config["whowas_duration"], int):
 			raise ConfigValidationError("whowas_duration", "value must be an integer or a duration string")
 		if "whowas_max_entries" in config and (not isinstance(config["whowas_max_entries"], int) or config["whowas_max_entries"] < 0):
 			raise  ConfigValidationError("whowas_max_entries", "invalid number")
+		if "whowas_max_total_entries" in config and (not isinstance(config["whowas_max_total_entries"], int) or config["whowas_max_total_entries"] < 0):
+			raise ConfigValidationError("whowas_max_total_entries", "invalid number")
+	
+	def loadHistory(self):
+		"""
+		Builds the history of all WHOWAS entries from storage, converting entries
+		saved in the older dictionary format.
+		Each entry is a tuple of (nick, ident, host, gecos, server, when). The
+		entries for each nickname are stored oldest first in a deque, and the
+		history holds (lowerNick, entry) pairs for all entries, oldest first.
+		"""
+		allWhowas = self.ircd.storage["whowas"]
+		history = []
+		for lowerNick, whowasEntries in allWhowas.items():
+			if not isinstance(whowasEntries, deque) or any(not isinstance(entry, tuple) for entry in whowasEntries):
+				whowasEntries = deque(entry if isinstance(entry, tuple) else (entry["nick"], entry["ident"], entry["host"], entry["gecos"], entry["server"], entry["when"]) for entry in whowasEntries)
+				allWhowas[lowerNick] = whowasEntries
+				self.ircd.storage.markDirty("whowas", lowerNick)
+			for entry in whowasEntries:
+				history.append((lowerNick, entry))
+		history.sort(key=lambda historyEntry: historyEntry[1][5])
+		self.history = deque(history)
+		self.entryCount = len(history)
+	
+	def removeOldestEntry(self):
+		"""
+		Removes the oldest entry from the history. Entries already removed from
+		their nickname's entries are skipped. Entries are compared by value, as
+		the data store may give back copies of the stored entries.
+		"""
+		lowerNick, entry = self.history.popleft()
+		allWhowas = self.ircd.storage["whowas"]
+		if lowerNick not in allWhowas or allWhowas[lowerNick][0] != entry:
+			return
+		whowasEntries = allWhowas[lowerNick]
+		whowasEntries.popleft()
+		if not whowasEntries:
+			del allWhowas[lowerNick]
+		self.entryCount -= 1
+		self.ircd.storage.markDirty("whowas", lowerNick)
 	
-	def removeOldEntries(self, whowasEntries):
-		expireDuration = durationToSeconds(self.ircd.config.get("whowas_duration", "1d"))
+	def trimHistory(self):
+		"""
+		Removes expired entries and the oldest entries beyond the maximum total
+		number of entries.
+		"""
+		maxTotal = self.ircd.config.get("whowas_max_total_entries", 20000)
+		expireTime = nowTimestamp() - durationToSeconds(self.ircd.config.get("whowas_duration", "1d"))
+		while self.history and (self.entryCount > maxTotal or self.history[0][1][5] <= expireTime):
+			self.removeOldestEntry()
+	
+	def trimNickEntries(self, lowerNick):
+		"""
+		Removes the oldest entries for a nickname beyond the maximum number of
+		entries per nickname. They stay in the history until they're skipped or
+		the history is compacted.
+		"""
+		allWhowas = self.ircd.storage["whowas"]
+		whowasEntries = allWhowas[lowerNick]
 		maxCount = self.ircd.config.get("whowas_max_entries", 10)
-		while whowasEntries and len(whowasEntries) > maxCount:
-			whowasEntries.pop(0)
-		expireTime = timestamp(now()) - expireDuration
-		while whowasEntries and whowasEntries[0]["when"] < expireTime:
-			whowasEntries.pop(0)
-		return whowasEntries
+		if len(whowasEntries) <= maxCount:
+			return
+		while len(whowasEntries) > maxCount:
+			whowasEntries.popleft()
+			self.entryCount -= 1
+		if not whowasEntries:
+			del allWhowas[lowerNick]
+		self.ircd.storage.markDirty("whowas", lowerNick)
+	
+	def compactHistory(self):
+		"""
+		Drops entries that were removed for their nicknames from the history
+		once they make up more than half of it.
+		"""
+		if len(self.history) <= 2 * self.entryCount:
+			return
+		keptEntries = Counter()
+		for lowerNick, whowasEntries in self.ircd.storage["whowas"].iteritems():
+			for entry in whowasEntries:
+				keptEntries[(lowerNick, entry)] += 1
+		history = deque()
+		for historyEntry in self.history:
+			if keptEntries[historyEntry] > 0:
+				keptEntries[historyEntry] -= 1
+				history.append(historyEntry)
+		self.history = history
+	
+	def scheduleHistoryExpiry(self):
+		"""
+		Schedules the removal of the oldest entry in the history. Since entries
+		are removed oldest first, only one removal is scheduled at a time.
+		"""
+		if self.historyExpiry is not None:
+			self.ircd.cancelExpiry(self.historyExpiry)
+			self.historyExpiry = None
+		if self.history:
+			expireDuration = durationToSeconds(self.ircd.config.get("whowas_duration", "1d"))
+			self.historyExpiry = self.ircd.scheduleExpiry(self.history[0][1][5] + expireDuration, self.expireEntries)
+	
+	def expireEntries(self):
+		self.historyExpiry = None
+		self.trimHistory()
+		self.scheduleHistoryExpiry()
 	
 	def addUserToWhowas(self, user, reason):
 		if not user.isRegistered():
 			# user never registered a nick, so no whowas entry to add
 			return
 		lowerNick = ircLower(user.nick)
-		allWhowas = self.ircd.storage["whowas"]
-		if lowerNick in allWhowas:
-			whowasEntries = allWhowas[lowerNick]
-		else:
-			whowasEntries = []
 		serverName = self.ircd.name
 		if user.uuid[:3] != self.ircd.serverID:
 			serverName = self.ircd.servers[user.uuid[:3]].name
-		whowasEntries.append({
-			"nick": user.nick,
-			"ident": user.ident,
-			"host": user.host(),
-			"gecos": user.gecos,
-			"server": serverName,
-			"when": timestamp(now())
-		})
-		whowasEntries = self.removeOldEntries(whowasEntries)
-		if whowasEntries:
-			allWhowas[lowerNick] = whowasEntries
-		elif lowerNick in allWhowas:
-			del allWhowas[lowerNick]
+		entry = (user.nick, user.ident, user.host(), user.gecos, serverName, nowTimestamp())
+		allWhowas = self.ircd.storage["whowas"]
+		if lowerNick not in allWhowas:
+			allWhowas[lowerNick] = deque()
+		allWhowas[lowerNick].append(entry)
+		self.ircd.storage.markDirty("whowas", lowerNick)
+		oldestHistoryEntry = self.history[0] if self.history else None
+		self.history.append((lowerNick, entry))
+		self.entryCount += 1
+		self.trimNickEntries(lowerNick)
+		self.trimHistory()
+		self.compactHistory()
+		if not self.history or self.history[0] is not oldestHistoryEntry:
+			self.scheduleHistoryExpiry()
 	
 	def parseParams(self, user, params, prefix, tags):
 		if not params:
@@ -82,20 +188,9 @@ class WhowasCommand(ModuleData, Command):
 	
 	def execute(self, user, data):
 		nick = data["nick"]
-		allWhowas = self.ircd.storage["whowas"]
-		whowasEntries = allWhowas[nick]
-		whowasEntries = self.removeOldEntries(whowasEntries)
-		if not whowasEntries:
-			del allWhowas[nick]
-			self.ircd.storage["whowas"] = allWhowas
-			user.sendMessage(irc.ERR_WASNOSUCHNICK, data["param"], "There was no such nickname")
-			return True
-		allWhowas[nick] = whowasEntries # Save back to the list excluding the removed entries
-		self.ircd.storage["whowas"] = allWhowas
-		for entry in whowasEntries:
-			entryNick = entry["nick"]
-			user.sendMessage(irc.RPL_WHOWASUSER, entryNick, entry["ident"], entry["host"], "*", entry["gecos"])
-			user.sendMessage(irc.RPL_WHOISSERVER, entryNick, entry["server"], str(datetime.utcfromtimestamp(entry["when"])))
+		for entryNick, ident, host, gecos, server, when in self.ircd.storage["whowas"][nick]: # Expired entries have already been removed
+			user.sendMessage(irc.RPL_WHOWASUSER, entryNick, ident, host, "*", gecos)
+			user.sendMessage(irc.RPL_WHOISSERVER, entryNick, server, str(datetime.utcfromtimestamp(when)))
 		user.sendMessage(irc.RPL_ENDOFWHOWAS, nick, "End of WHOWAS")
 		return True
 
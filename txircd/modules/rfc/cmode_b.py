@@ -3,7 +3,10 @@ from twisted.words.protocols import irc
 from txircd.module_interface import IMode, IModuleData, Mode, ModuleData
 from txircd.utils import ircLower, ModeType, timestamp
 from zope.interface import implements
-from fnmatch import fnmatchcase
+from fnmatch import translate
+import re
+
+parsedBanCacheSize = 8192
 
 class BanMode(ModuleData, Mode):
 	implements(IPlugin, IModuleData, IMode)
@@ -25,28 +28,97 @@ class BanMode(ModuleData, Mode):
 		         ("updateuserbancache", 1, self.updateUserCaches)
 		]
 	
-	def banMatchesUser(self, user, banmask):
+	def load(self):
+		self.parsedBans = {}
+		self.parsedMatchMasks = {}
+	
+	def parseBan(self, param):
+		"""
+		Splits a ban list entry into its action extban, the action extban's
+		parameter, and the parsed matching part of the entry (as returned by
+		parseMatchMask). Entries are parsed once and cached, since the same
+		entries are checked on every join.
+		"""
+		if param in self.parsedBans:
+			return self.parsedBans[param]
+		actionExtban = ""
+		actionParam = ""
+		banmask = param
+		if ";" in banmask:
+			actionExtban, banmask = banmask.split(";", 1)
+			if ":" in actionExtban:
+				actionExtban, actionParam = actionExtban.split(":", 1)
+		parsedBan = (actionExtban, actionParam, self.parseMatchMask(banmask))
+		if len(self.parsedBans) >= parsedBanCacheSize:
+			self.parsedBans.clear()
+		self.parsedBans[param] = parsedBan
+		return parsedBan
+	
+	def parseMatchMask(self, banmask):
+		"""
+		Parses the matching part of a ban list entry into a tuple of the
+		matching extban, whether the matching extban is negated, the remaining
+		mask, and a function matching lowercased hostmasks against the mask
+		(None if a matching extban is used).
+		"""
+		if banmask in self.parsedMatchMasks:
+			return self.parsedMatchMasks[banmask]
 		matchingExtban = ""
 		matchNegated = False
-		if ":" in banmask and ("@" not in banmask or banmask.find(":") < banmask.find("@")):
-			matchingExtban, banmask = banmask.split(":", 1)
+		mask = banmask
+		if ":" in mask and ("@" not in mask or mask.find(":") < mask.find("@")):
+			matchingExtban, mask = mask.split(":", 1)
 			if matchingExtban and matchingExtban[0] == "~":
 				matchNegated = True
 				matchingExtban = matchingExtban[1:]
+		if matchingExtban:
+			hostmaskMatcher = None
+		else:
+			hostmaskMatcher = self.compileHostmaskMatcher(ircLower(mask))
+		parsedMask = (matchingExtban, matchNegated, mask, hostmaskMatcher)
+		if len(self.parsedMatchMasks) >= parsedBanCacheSize:
+			self.parsedMatchMasks.clear()
+		self.parsedMatchMasks[banmask] = parsedMask
+		return parsedMask
+	
+	def compileHostmaskMatcher(self, lowerMask):
+		if "*" not in lowerMask and "?" not in lowerMask and "[" not in lowerMask:
+			return lambda userMask: userMask == lowerMask
+		return re.compile(translate(lowerMask)).match
+	
+	def lowerUserHostmasks(self, user):
+		"""
+		Returns the user's hostmask, hostmask with real host, and hostmask with
+		IP, all lowercased. These are cached on the user until any of the parts
+		that make them up change.
+		"""
+		hostmaskParts = (user.nick, user.ident, user.host(), user.realHost, user.ip)
+		if "banhostmasks" in user.cache:
+			cachedParts, lowerHostmasks = user.cache["banhostmasks"]
+			if cachedParts == hostmaskParts:
+				return lowerHostmasks
+		lowerHostmasks = (ircLower(user.hostmask()), ircLower(user.hostmaskWithRealHost()), ircLower(user.hostmaskWithIP()))
+		user.cache["banhostmasks"] = (hostmaskParts, lowerHostmasks)
+		return lowerHostmasks
+	
+	def banMatchesUser(self, user, banmask):
+		return self.matchMaskMatchesUser(user, self.parseMatchMask(banmask))
+	
+	def matchMaskMatchesUser(self, user, parsedMask):
+		matchingExtban, matchNegated, banmask, hostmaskMatcher = parsedMask
 		if matchingExtban:
 			return self.ircd.runActionUntilTrue("usermatchban-{}".format(matchingExtban), user, matchNegated, banmask)
-		return self.matchHostmask(user, banmask)
+		for userMask in self.lowerUserHostmasks(user):
+			if hostmaskMatcher(userMask):
+				return True
+		return False
 	
 	def matchHostmask(self, user, banmask):
-		banmask = ircLower(banmask)
-		userMask = ircLower(user.hostmask())
-		if fnmatchcase(userMask, banmask):
-			return True
-		userMask = ircLower(user.hostmaskWithRealHost())
-		if fnmatchcase(userMask, banmask):
-			return True
-		userMask = ircLower(user.hostmaskWithIP())
-		return fnmatchcase(userMask, banmask)
+		matcher = self.compileHostmaskMatcher(ircLower(banmask))
+		for userMask in self.lowerUserHostmasks(user):
+			if matcher(userMask):
+				return True
+		return False
 	
 	def checkAction(self, actionName, mode, channel, user, *params, **kw):
 		if "b" not in channel.modes:
@@ -60,41 +132,15 @@ class BanMode(ModuleData, Mode):
 				return channel.users[user]["bans"][mode]
 			return None
 		for paramData in channel.modes["b"]:
-			param = paramData[0]
-			actionExtban = ""
-			actionParam = ""
-			if ";" in param:
-				actionExtban, param = param.split(";", 1)
-				if ":" in actionExtban:
-					actionExtban, actionParam = actionExtban.split(":", 1)
+			actionExtban, actionParam, parsedMask = self.parseBan(paramData[0])
 			if actionExtban != mode:
 				continue
-			match = self.banMatchesUser(user, param)
-			if match:
+			if self.matchMaskMatchesUser(user, parsedMask):
 				return actionParam
 		return None
 	
 	def onChange(self, channel, source, adding, param):
-		if ";" in param:
-			actionExtban, banmask = param.split(";", 1)
-			if ":" in actionExtban:
-				actionExtban, actionParam = actionExtban.split(":", 1)
-			else:
-				actionParam = ""
-		else:
-			actionExtban= ""
-			actionParam = ""
-			banmask = param
-		if ":" in banmask and ("@" not in banmask or banmask.index(":") < banmask.index("@")):
-			matchingExtban, banmask = banmask.split(":", 1)
-			if matchingExtban and matchingExtban[0] == "~":
-				matchNegated = True
-				matchingExtban = matchingExtban[1:]
-			else:
-				matchNegated = False
-		else:
-			matchingExtban = ""
-			matchNegated = None
+		actionExtban, actionParam, parsedMask = self.parseBan(param)
 		for user, cache in channel.users.iteritems():
 			if "bans" not in cache:
 				cache["bans"] = {}
@@ -102,11 +148,7 @@ class BanMode(ModuleData, Mode):
 				continue # If it didn't affect them before, it won't now, so let's skip the mongo processing we're about to do to them
 			if (actionExtban in cache["bans"]) and adding and actionParam == cache["bans"][actionExtban]:
 				continue
-			if matchingExtban:
-				matchesUser = self.ircd.runActionUntilTrue("usermatchban-{}".format(matchingExtban), user, matchNegated, banmask)
-			else:
-				matchesUser = self.matchHostmask(user, banmask)
-			if not matchesUser:
+			if not self.matchMaskMatchesUser(user, parsedMask):
 				continue
 			if adding:
 				cache["bans"][actionExtban] = actionParam
@@ -119,28 +161,11 @@ class BanMode(ModuleData, Mode):
 		if "b" in channel.modes:
 			matchesActions = {}
 			for paramData in channel.modes["b"]:
-				param = paramData[0]
-				actionExtban = ""
-				actionParam = ""
-				matchingExtban = ""
-				matchNegated = False
-				if ";" in param:
-					actionExtban, param = param.split(";", 1)
-					if ":" in actionExtban:
-						actionExtban, actionParam = actionExtban.split(":", 1)
+				actionExtban, actionParam, parsedMask = self.parseBan(paramData[0])
 				if actionExtban in matchesActions:
 					continue
-				if ":" in param and ("@" not in param or param.find(":") < param.find("@")):
-					matchingExtban, param = param.split(":", 1)
-					if matchingExtban[0] == "~":
-						matchNegated = True
-						matchingExtban = matchingExtban[1:]
-				if matchingExtban:
-					if self.ircd.runActionUntilTrue("usermatchban-{}".format(matchingExtban), user, matchNegated, param):
-						matchesActions[actionExtban] = actionParam
-				else:
-					if self.matchHostmask(user, param):
-						matchesActions[""] = ""
+				if self.matchMaskMatchesUser(user, parsedMask):
+					matchesActions[actionExtban] = actionParam
 			return matchesActions
 		return {}
 
@@ -162,16 +187,10 @@ class BanMode(ModuleData, Mode):
 		if "bans" not in channel.users[user]:
 			channel.users[user]["bans"] = {}
 		for paramData in channel.modes["b"]:
-			param = paramData[0]
-			actionExtban = ""
-			actionParam = ""
-			if ";" in param:
-				actionExtban, param = param.split(";", 1)
-				if ":" in actionExtban:
-					actionExtban, actionParam = actionExtban.split(":", 1)
+			actionExtban, actionParam, parsedMask = self.parseBan(paramData[0])
 			if actionExtban in channel.users[user]["bans"]:
 				continue
-			if self.banMatchesUser(user, param):
+			if self.matchMaskMatchesUser(user, parsedMask):
 				channel.users[user]["bans"][actionExtban] = actionParam
 	
 	def autoStatus(self, channel, user):
@@ -261,7 +280,7 @@ class BanMode(ModuleData, Mode):
 			param = paramData[0]
 			if ";" in param:
 				continue # Ignore entries with action extbans
-			if self.banMatchesUser(user, param):
+			if self.matchMaskMatchesUser(user, self.parseBan(param)[2]):
 				user.sendMessage(irc.ERR_BANNEDFROMCHAN, channel.name, "Cannot join channel (You're banned)")
 				return False
 		return None
@@ -16,6 +16,8 @@ class IRCServer(IRCBase):
 		self.bursted = None
 		self.disconnectedDeferred = Deferred()
 		self.receivedConnection = received
+		self._bufferOutput = self.ircd.config.get("server_output_buffering", False)
+		self._outputBufferHighWater = self.ircd.config.get("output_buffer_high_water", 16384)
 		self._pinger = LoopingCall(self._ping)
 		self._registrationTimeoutTimer = reactor.callLater(self.ircd.config.get("server_registration_timeout", 10), self._timeoutRegistration)
 	
@@ -101,7 +103,7 @@ class IRCServer(IRCBase):
 		self._endConnection()
 	
 	def _endConnection(self):
-		self.transport.loseConnection()
+		self.closeConnection()
 	
 	def _timeoutRegistration(self):
 		if self.serverID and self.name:
@@ -0,0 +1,290 @@
+from twisted.internet.threads import deferToThread
+from twisted.logger import Logger
+from collections import MutableMapping
+from shelve import DbfilenameShelf
+from threading import Lock
+from time import time
+import cPickle, os, shelve, struct
+
+class ShelveStorage(DbfilenameShelf):
+	"""
+	The original shelve data store. All entries that have been accessed are
+	written back on every sync, so there's nothing to do when entries are
+	marked as changed.
+	"""
+	backendName = "shelve"
+	
+	def __init__(self, filename):
+		DbfilenameShelf.__init__(self, filename, writeback=True)
+		self.syncCount = 0
+		self.lastSyncDuration = 0
+		self.lastSyncPrepareDuration = 0
+		self.lastSyncBytes = None
+		self.totalSyncBytes = None
+	
+	def markDirty(self, key, subkey = None):
+		pass
+	
+	def sync(self):
+		startTime = time()
+		DbfilenameShelf.sync(self)
+		self.syncCount += 1
+		self.lastSyncDuration = time() - startTime
+		self.lastSyncPrepareDuration = self.lastSyncDuration # It's all done on the calling thread
+
+journalHeader = ("txircd-journal", 1)
+recordLength = struct.Struct("!I")
+
+class JournalStorage(MutableMapping):
+	"""
+	A data store that keeps all data in memory and saves changes by appending
+	them to a journal file. Only entries that have changed since the last sync
+	are written. The journal is compacted into a snapshot of the current data
+	when it grows to more than twice the size of the last snapshot.
+
+	Assigning or deleting a top-level key marks it as changed. Code that
+	changes a stored value in place must call markDirty for the change to be
+	saved, passing the key of the changed item as the subkey when the stored
+	value is a dictionary so that only that item is written.
+	
+	Changes can be written from a worker thread with syncInThread. The changes
+	are pickled on the calling thread, which keeps the data from changing while
+	it's being written, and only the file writes happen in the worker.
+	"""
+	backendName = "journal"
+	log = Logger()
+	
+	def __init__(self, filename, importFromShelf = None):
+		self.filename = filename
+		self._data = {}
+		self._dirty = {}
+		self._journalBytes = 0
+		self._snapshotBytes = 0
+		self._compactNeeded = False
+		self._writeLock = Lock()
+		self._threadedWrite = None
+		self.syncCount = 0
+		self.lastSyncDuration = 0
+		self.lastSyncPrepareDuration = 0
+		self.lastSyncBytes = 0
+		self.totalSyncBytes = 0
+		if os.path.exists(filename):
+			self._readJournal()
+		elif importFromShelf:
+			self._importShelf(importFromShelf)
+		self._journal = open(filename, "ab")
+		if not self._journalBytes:
+			self.compact()
+		
+	def _readJournal(self):
+		with open(self.filename, "rb") as journal:
+			validLength = 0
+			header = True
+			while True:
+				lengthData = journal.read(recordLength.size)
+				if len(lengthData) < recordLength.size:
+					break
+				length = recordLength.unpack(lengthData)[0]
+				recordData = journal.read(length)
+				if len(recordData) < length:
+					break # The last record was only partially written, so it's ignored
+				record = cPickle.loads(recordData)
+				if header:
+					if record != journalHeader:
+						raise ValueError("{} is not a txircd data journal".format(self.filename))
+					header = False
+				else:
+					self._applyRecord(record)
+				validLength += recordLength.size + length
+		if validLength < os.path.getsize(self.filename):
+			with open(self.filename, "r+b") as journal:
+				journal.truncate(validLength)
+		self._journalBytes = validLength
+		self._snapshotBytes = validLength
+	
+	def _applyRecord(self, record):
+		action = record[0]
+		if action == "set":
+			self._data[record[1]] = record[2]
+		elif action == "del":
+			self._data.pop(record[1], None)
+		elif action == "setitem":
+			self._data[record[1]][record[2]] = record[3]
+		elif action == "delitem":
+			self._data[record[1]].pop(record[2], None)
+	
+	def _importShelf(self, filename):
+		try:
+			shelf = shelve.open(filename, flag="r")
+		except Exception:
+			return # There's no shelf to import
+		try:
+			for key in shelf.keys():
+				self._data[key] = shelf[key]
+		finally:
+			shelf.close()
+	
+	def __getitem__(self, key):
+		return self._data[key]
+	
+	def __setitem__(self, key, value):
+		self._data[key] = value
+		self._dirty[key] = None
+	
+	def __delitem__(self, key):
+		del self._data[key]
+		self._dirty[key] = None
+	
+	def __contains__(self, key):
+		return key in self._data
+	
+	def __iter__(self):
+		return iter(self._data)
+	
+	def __len__(self):
+		return len(self._data)
+	
+	def markDirty(self, key, subkey = None):
+		"""
+		Marks a key as changed so that it's written on the next sync. If a
+		subkey is given, only that item of the dictionary stored at the key is
+		written.
+		"""
+		if subkey is None:
+			self._dirty[key] = None
+		elif key not in self._dirty:
+			self._dirty[key] = set([subkey])
+		elif self._dirty[key] is not None:
+			self._dirty[key].add(subkey)
+	
+	def _changeRecords(self):
+		records = []
+		for key, subkeys in self._dirty.iteritems():
+			if key not in self._data:
+				records.append(("del", key))
+			elif subkeys is None:
+				records.append(("set", key, self._data[key]))
+			else:
+				value = self._data[key]
+				for subkey in subkeys:
+					if subkey in value:
+						records.append(("setitem", key, subkey, value[subkey]))
+					else:
+						records.append(("delitem", key, subkey))
+		self._dirty = {}
+		return records
+	
+	def _serializeRecords(self, records):
+		recordData = []
+		for record in records:
+			pickledRecord = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+			recordData.append(recordLength.pack(len(pickledRecord)))
+			recordData.append(pickledRecord)
+		return "".join(recordData)
+	
+	def _prepareWrite(self):
+		"""
+		Pickles the changes since the last write, or a snapshot of all data if
+		the journal needs compacting. Returns a tuple of the data to write and
+		whether it replaces the journal.
+		"""
+		if self._compactNeeded:
+			return self._prepareSnapshot(), True
+		if not self._dirty:
+			return None, False
+		journalData = self._serializeRecords(self._changeRecords())
+		if self._journalBytes + len(journalData) > 2 * self._snapshotBytes and self._journalBytes + len(journalData) > 1048576:
+			return self._prepareSnapshot(), True
+		self._journalBytes += len(journalData)
+		return journalData, False
+	
+	def _prepareSnapshot(self):
+		self._dirty = {}
+		self._compactNeeded = False
+		records = [journalHeader] + [("set", key, value) for key, value in self._data.iteritems()]
+		snapshotData = self._serializeRecords(records)
+		self._journalBytes = len(snapshotData)
+		self._snapshotBytes = len(snapshotData)
+		return snapshotData
+	
+	def _writeData(self, writeData, isSnapshot):
+		"""
+		Writes prepared data to disk. This only touches the journal file, so it's
+		safe to run in a worker thread.
+		"""
+		with self._writeLock:
+			try:
+				if isSnapshot:
+					tempFilename = "{}.tmp".format(self.filename)
+					with open(tempFilename, "wb") as snapshotFile:
+						snapshotFile.write(writeData)
+						snapshotFile.flush()
+						os.fsync(snapshotFile.fileno())
+					self._journal.close()
+					os.rename(tempFilename, self.filename)
+					self._journal = open(self.filename, "ab")
+				else:
+					self._journal.write(writeData)
+					self._journal.flush()
+					os.fsync(self._journal.fileno())
+			except:
+				# The journal may now end in a partial record, so the next write needs to replace it
+				self._compactNeeded = True
+				raise
+	
+	def sync(self):
+		"""
+		Appends all changes since the last sync to the journal, compacting the
+		journal if it has grown too large.
+		"""
+		startTime = time()
+		writeData, isSnapshot = self._prepareWrite()
+		if writeData is None:
+			return
+		self.lastSyncPrepareDuration = time() - startTime
+		self._writeData(writeData, isSnapshot)
+		self._recordSync(startTime, len(writeData))
+	
+	def syncInThread(self):
+		"""
+		Prepares all changes since the last sync on the calling thread and writes
+		them from a worker thread. Returns a Deferred that fires when the write
+		is complete, or None if there was nothing to write. If the previous
+		write is still running, nothing is done and its Deferred is returned.
+		"""
+		if self._threadedWrite is not None:
+			return self._threadedWrite
+		startTime = time()
+		writeData, isSnapshot = self._prepareWrite()
+		if writeData is None:
+			return None
+		self.lastSyncPrepareDuration = time() - startTime
+		self._threadedWrite = deferToThread(self._writeData, writeData, isSnapshot)
+		self._threadedWrite.addCallbacks(self._finishThreadedWrite, self._failThreadedWrite, (startTime, len(writeData)))
+		return self._threadedWrite
+	
+	def _finishThreadedWrite(self, result, startTime, byteCount):
+		self._threadedWrite = None
+		self._recordSync(startTime, byteCount)
+	
+	def _failThreadedWrite(self, failure):
+		self._threadedWrite = None
+		self.log.failure("Failed to write data journal {filename}", failure, filename=self.filename)
+	
+	def _recordSync(self, startTime, byteCount):
+		self.syncCount += 1
+		self.lastSyncDuration = time() - startTime
+		self.lastSyncBytes = byteCount
+		self.totalSyncBytes += byteCount
+	
+	def compact(self):
+		"""
+		Replaces the journal with a snapshot of the current data.
+		"""
+		self._writeData(self._prepareSnapshot(), True)
+	
+	def close(self):
+		with self._writeLock: # Wait for a write running in a worker thread
+			pass
+		self.sync()
+		self._journal.close()
@@ -6,7 +6,8 @@ from twisted.names import client as dnsClient
 from twisted.words.protocols import irc
 from txircd import version
 from txircd.ircbase import IRCBase
-from txircd.utils import CaseInsensitiveDictionary, expandIPv6Address, ipIsV4, isValidHost, isValidMetadataKey, ModeType, now, splitMessage
+from txircd.utils import CaseInsensitiveDictionary, expandIPv6Address, ipIsV4, isValidHost, isValidMetadataKey, ModeType, now
+from collections import deque
 
 irc.ERR_ALREADYREGISTERED = "462"
 
@@ -44,6 +45,16 @@ class IRCUser(IRCBase):
 		self.ircd.users[self.uuid] = self
 		self.localOnly = False
 		self.secureConnection = False
+		self._bufferOutput = self.ircd.config.get("user_output_buffering", False)
+		self._outputBufferHighWater = self.ircd.config.get("output_buffer_high_water", 16384)
+		self._sendQLimit = self.ircd.config.get("user_sendq_limit", 262144)
+		self._abortOnClose = False
+		self._recvQ = deque()
+		self._recvQSize = 0
+		self._commandsScheduled = False
+		self._processingLine = None
+		self._retryProcessingLine = False
+		self._commandDelayCall = None
 		self._pinger = LoopingCall(self._ping)
 		self._registrationTimeoutTimer = reactor.callLater(registrationTimeout, self._timeoutRegistration)
 		self._connectHandlerTimer = None
@@ -87,11 +98,12 @@ class IRCUser(IRCBase):
 		self._connectHandlerTimer = reactor.callLater(0.1, self._callConnectAction)
 		if ISSLTransport.providedBy(self.transport):
 			self.secureConnection = True
+		self.registerOutputProducer()
 	
 	def _callConnectAction(self):
 		self._connectHandlerTimer = None
 		if self.ircd.runActionUntilFalse("userconnect", self, users=[self]):
-			self.transport.loseConnection()
+			self.closeConnection()
 		else:
 			self.register("connection")
 	
@@ -104,10 +116,132 @@ class IRCUser(IRCBase):
 			if self.uuid in self.ircd.users:
 				self.disconnect("Error occurred")
 	
+	def lineReceived(self, data):
+		if self.uuid not in self.ircd.users:
+			return
+		if self._commandDelayCall is not None and self._isDelayExempt(data):
+			self._processLine(data)
+			return
+		self._recvQ.append(data)
+		self._recvQSize += len(data)
+		if self._recvQSize > self.ircd.config.get("user_recvq_limit", 32768):
+			self._recvQ.clear()
+			self._recvQSize = 0
+			self.disconnect("RecvQ exceeded")
+			return
+		if not self._commandsScheduled:
+			self._commandsScheduled = True
+			self.ircd.scheduleUserCommands(self)
+	
+	def processQueuedCommands(self, budget):
+		"""
+		Processes up to budget lines received from this user. Returns True if
+		the user has more lines waiting to be processed.
+		"""
+		while self._recvQ and budget > 0 and self._commandDelayCall is None:
+			if self.uuid not in self.ircd.users:
+				self._recvQ.clear()
+				self._recvQSize = 0
+				break
+			line = self._recvQ.popleft()
+			self._recvQSize -= len(line)
+			budget -= 1
+			# Lines may hold several commands separated by \r; each is processed separately so that
+			# a delay requested by one of them holds back only the commands after it
+			lineParts = line.split("\r")
+			for index, linePart in enumerate(lineParts):
+				if self.uuid not in self.ircd.users:
+					break
+				self._processLine(linePart)
+				if self._commandDelayCall is not None:
+					remainingParts = lineParts[index + 1:]
+					if self._retryProcessingLine:
+						remainingParts.insert(0, linePart)
+						self._retryProcessingLine = False
+					if remainingParts:
+						remainingLine = "\r".join(remainingParts)
+						self._recvQ.appendleft(remainingLine)
+						self._recvQSize += len(remainingLine)
+					break
+		if self._commandDelayCall is not None:
+			self._processDelayExemptLines()
+			return False # Processing resumes when the delay is over
+		if self._recvQ:
+			return True
+		self._commandsScheduled = False
+		return False
+	
+	def _processLine(self, line):
+		self._processingLine = line
+		try:
+			IRCBase.lineReceived(self, line)
+		except Exception:
+			self.ircd.log.failure("An error occurred while processing incoming data.")
+			if self.uuid in self.ircd.users:
+				self.disconnect("Error occurred")
+		self._processingLine = None
+	
+	def _isDelayExempt(self, line):
+		line = line.rstrip("\r")
+		if "\r" in line:
+			return False # Lines holding several commands are processed in order
+		return self._parseLine(line)[0] in ("PING", "PONG")
+	
+	def _processDelayExemptLines(self):
+		"""
+		Processes the PING and PONG lines waiting in the queue while commands
+		are delayed so that the delay can't make the user time out.
+		"""
+		exemptLines = [line for line in self._recvQ if self._isDelayExempt(line)]
+		if not exemptLines:
+			return
+		self._recvQ = deque(line for line in self._recvQ if not self._isDelayExempt(line))
+		for line in exemptLines:
+			self._recvQSize -= len(line)
+			if self.uuid not in self.ircd.users:
+				return
+			self._processLine(line)
+	
+	def delayCommands(self, delay, retryCurrent = False):
+		"""
+		Stops processing commands from this user for the given number of
+		seconds. Commands received in the meantime are queued, still subject
+		to the RecvQ limit, except for PING and PONG, which are always
+		processed right away.
+		If retryCurrent is True, the command currently being processed is put
+		back at the front of the queue to be processed again when the delay is
+		over; whatever requested the delay should also keep the current command
+		from running (e.g. by returning False from commandpermission). Only the
+		current command is retried, not any commands before it that arrived on
+		the same line.
+		"""
+		if retryCurrent and self._processingLine is not None:
+			self._retryProcessingLine = True
+		if self._commandDelayCall is not None:
+			self._commandDelayCall.cancel()
+		self._commandsScheduled = True
+		self._commandDelayCall = reactor.callLater(delay, self._endCommandDelay)
+	
+	def _endCommandDelay(self):
+		self._commandDelayCall = None
+		if self._recvQ:
+			self.ircd.scheduleUserCommands(self)
+		else:
+			self._commandsScheduled = False
+	
 	def sendLine(self, line):
 		self.ircd.runActionStandard("usersenddata", self, line, users=[self])
 		IRCBase.sendLine(self, line)
 	
+	def sendQExceeded(self):
+		self.ircd.log.info("Disconnecting user {user.uuid} ({user.hostmask()}) for exceeding the send queue limit", user=self)
+		reactor.callLater(0, self._disconnectForSendQ) # Don't disconnect in the middle of sending something else
+	
+	def _disconnectForSendQ(self):
+		if self.uuid in self.ircd.users:
+			self._abortOnClose = True # The client isn't reading, so don't wait to write anything else to it
+			self.disconnect("SendQ exceeded")
+	
 	def sendMessage(self, command, *args, **kw):
 		"""
 		Sends the given message to this user.
@@ -117,11 +251,43 @@ class IRCUser(IRCBase):
 		- to: The destination of the message or None if the message has no
 		    destination. The implicit destination is this user if this
 		    argument isn't specified.
-		- tags: Dict of message tags to send.
+		- tags: Dict of message tags to send. The dict may be shared with other
+		    recipients, so modifyoutgoingmessage handlers that change the tags
+		    should replace it rather than modify it.
 		- alwaysPrefixLastParam: For compatibility with some broken clients,
 		    you might want some messages to always have the last parameter
 		    prefixed with a colon. To do that, pass this as True.
+		- trusted: Pass True for server-generated parameters that are known
+		    not to contain illegal characters (e.g. MOTD lines checked when
+		    the MOTD was loaded) to skip checking them on every send.
 		"""
+		args = self._prepareMessage(command, args, kw)
+		IRCBase.sendMessage(self, command, *args, **kw)
+	
+	def sendSharedMessage(self, lineCache, command, *args, **kw):
+		"""
+		Sends the given message to this user, sharing the serialized line with
+		other users receiving the same message. The lineCache parameter is a
+		dict that should be shared between all recipients of the message;
+		each distinct resulting line is only built once.
+		Accepts the same keyword arguments as sendMessage, as well as:
+		- tagsKey: tuple(sorted(tags.iteritems())) for the given tags, for
+		    callers sending the same tags dict to many users to compute only
+		    once. It's ignored if the tags are replaced while preparing the
+		    message.
+		"""
+		tags = kw.get("tags", None)
+		tagsKey = kw.pop("tagsKey", None)
+		args = self._prepareMessage(command, args, kw)
+		if tagsKey is None or kw.get("tags", None) is not tags:
+			tags = kw.get("tags", None)
+			tagsKey = tuple(sorted(tags.iteritems())) if tags else None
+		lineKey = (command, tuple(args), kw.get("prefix", None), kw.get("alwaysPrefixLastParam", False), tagsKey)
+		if lineKey not in lineCache:
+			lineCache[lineKey] = self._buildMessageLine(command, *args, **kw)
+		self.sendLine(lineCache[lineKey])
+	
+	def _prepareMessage(self, command, args, kw):
 		if "prefix" not in kw:
 			kw["prefix"] = self.ircd.name
 		if kw["prefix"] is None:
@@ -133,7 +299,7 @@ class IRCUser(IRCBase):
 		if to:
 			args = [to] + list(args)
 		self.ircd.runActionStandard("modifyoutgoingmessage", self, command, args, kw)
-		IRCBase.sendMessage(self, command, *args, **kw)
+		return args
 	
 	def handleCommand(self, command, params, prefix, tags):
 		if self.uuid not in self.ircd.users:
@@ -259,10 +425,35 @@ class IRCUser(IRCBase):
 		return applyTags
 	
 	def connectionLost(self, reason):
+		if self.uuid in self.ircd.users:
+			self._processRemainingCommands()
 		if self.uuid in self.ircd.users:
 			self.disconnect("Connection reset")
 		self.disconnectedDeferred.callback(None)
 	
+	def _processRemainingCommands(self):
+		"""
+		Processes the lines still queued when the connection is lost, so that
+		commands sent just before the client closed the connection (such as
+		QUIT with a reason) aren't lost. If commands from this user are being
+		delayed, only a queued QUIT is processed.
+		"""
+		if self._commandDelayCall is None:
+			self.processQueuedCommands(len(self._recvQ))
+		if self.uuid not in self.ircd.users or not self._recvQ:
+			return
+		for line in self._recvQ:
+			for linePart in line.split("\r"):
+				command, params, prefix, tags = self._parseLine(linePart)
+				if command and command.upper() == "QUIT":
+					self._recvQ.clear()
+					self._recvQSize = 0
+					try:
+						self.handleCommand(command, params, prefix, tags)
+					except Exception:
+						self.ircd.log.failure("An error occurred while processing incoming data.")
+					return
+	
 	def disconnect(self, reason):
 		"""
 		Disconnects the user from the server.
@@ -283,6 +474,9 @@ class IRCUser(IRCBase):
 		if self._connectHandlerTimer and self._connectHandlerTimer.active():
 			self._connectHandlerTimer.cancel()
 			self._connectHandlerTimer = None
+		if self._commandDelayCall:
+			self._commandDelayCall.cancel()
+			self._commandDelayCall = None
 		self.ircd.recentlyQuitUsers[self.uuid] = now()
 		del self.ircd.users[self.uuid]
 		if self.isRegistered():
@@ -296,7 +490,7 @@ class IRCUser(IRCBase):
 		userSendList.remove(self)
 		self.ircd.runActionProcessing("quitmessage", userSendList, self, reason, users=[self] + userSendList)
 		self.ircd.runActionStandard("quit", self, reason, users=self)
-		self.transport.loseConnection()
+		self.closeConnection(self._abortOnClose)
 	
 	def _timeoutRegistration(self):
 		if self.isRegistered():
@@ -330,18 +524,22 @@ class IRCUser(IRCBase):
 				return
 			self._registerHolds.add("registercheck") # The user shouldn't be considered registered until we complete these final checks
 			if self.ircd.runActionUntilFalse("register", self, users=[self]):
-				self.transport.loseConnection()
+				self.closeConnection()
 				return
 			self._registerHolds.remove("registercheck")
 			self.ircd.userNicks[self.nick] = self.uuid
 			self.ircd.log.debug("Registering user {user.uuid} ({user.hostmask()})", user=self)
+			# Modules may give a user a different send queue limit by returning the limit in bytes from the
+			# usersendqlimit action (e.g. for connection classes); no module shipped with txircd does this yet.
+			sendQLimit = self.ircd.runActionUntilValue("usersendqlimit", self, users=[self])
+			if sendQLimit is not None:
+				self._sendQLimit = sendQLimit
 			versionWithName = "txircd-{}".format(version)
 			self.sendMessage(irc.RPL_WELCOME, "Welcome to the {} Internet Relay Chat Network {}".format(self.ircd.config["network_name"], self.hostmask()))
-			self.sendMessage(irc.RPL_YOURHOST, "Your host is {}, running version {}".format(self.ircd.name, versionWithName))
-			self.sendMessage(irc.RPL_CREATED, "This server was created {}".format(self.ircd.startupTime.replace(microsecond=0)))
-			chanModes = "".join(["".join(modes.keys()) for modes in self.ircd.channelModes])
-			chanModes += "".join(self.ircd.channelStatuses.keys())
-			self.sendMessage(irc.RPL_MYINFO, self.ircd.name, versionWithName, "".join(["".join(modes.keys()) for modes in self.ircd.userModes]), chanModes)
+			self.sendMessage(irc.RPL_YOURHOST, "Your host is {}, running version {}".format(self.ircd.name, versionWithName), trusted=True)
+			self.sendMessage(irc.RPL_CREATED, "This server was created {}".format(self.ircd.startupTime.replace(microsecond=0)), trusted=True)
+			userModes, chanModes = self.ircd.getModeLists()
+			self.sendMessage(irc.RPL_MYINFO, self.ircd.name, versionWithName, userModes, chanModes, trusted=True)
 			self.sendISupport()
 			self.ircd.runActionStandard("welcome", self, users=[self])
 	
@@ -356,12 +554,8 @@ class IRCUser(IRCBase):
 	def sendISupport(self):
 		"""
 		Sends ISUPPORT to this user."""
-		isupportList = self.ircd.generateISupportList()
-		isupportMsgList = splitMessage(" ".join(isupportList), 350)
-		for line in isupportMsgList:
-			lineArgs = line.split(" ")
-			lineArgs.append("are supported by this server")
-			self.sendMessage(irc.RPL_ISUPPORT, *lineArgs)
+		for lineArgs in self.ircd.getISupportLines():
+			self.sendMessage(irc.RPL_ISUPPORT, *lineArgs, trusted=True)
 	
 	def hostmask(self):
 		"""
@@ -850,6 +1044,9 @@ class RemoteUser(IRCUser):
 	def sendMessage(self, command, *params, **kw):
 		pass # Messages can't be sent directly to remote users.
 	
+	def sendSharedMessage(self, lineCache, command, *params, **kw):
+		pass
+	
 	def register(self, holdName, fromRemote = False):
 		"""
 		Handles registration of a remote user.
@@ -989,6 +1186,15 @@ class LocalUser(IRCUser):
 		"""
 		self._sendMsgFunc(self, command, *args, **kw)
 	
+	def sendSharedMessage(self, lineCache, command, *args, **kw):
+		"""
+		Sends a message to this user. Local users don't share serialized
+		messages, so this is the same as sendMessage.
+		"""
+		if "tagsKey" in kw:
+			del kw["tagsKey"]
+		self._sendMsgFunc(self, command, *args, **kw)
+	
 	def disconnect(self, reason):
 		"""
 		Cleans up and removes the user.
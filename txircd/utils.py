@@ -1,6 +1,8 @@
 from collections import MutableMapping
 from datetime import datetime
-import re
+from binascii import hexlify, unhexlify
+from time import time
+import re, socket
 
 validNick = re.compile(r"^[a-zA-Z\-\[\]\\`^{}_|][a-zA-Z0-9\-\[\]\\^{}_|]*$")
 def isValidNick(nick):
@@ -79,18 +81,32 @@ class CaseInsensitiveDictionary(MutableMapping):
 		self._data[ircLower(key)] = value
 
 
+_currentSecond = [None, None]
 def now():
 	"""
 	Returns a datetime object representing now.
+	Since the result only has a resolution of one second, the same object is
+	returned until the second changes.
 	"""
-	return datetime.utcnow().replace(microsecond=0)
+	currentSecond = int(time())
+	if currentSecond != _currentSecond[0]:
+		_currentSecond[0] = currentSecond
+		_currentSecond[1] = datetime.utcfromtimestamp(currentSecond)
+	return _currentSecond[1]
 
+def nowTimestamp():
+	"""
+	Returns the current Unix timestamp. This is the same as timestamp(now())
+	but doesn't need a datetime object.
+	"""
+	return int(time())
+
+_unixEpoch = datetime.utcfromtimestamp(0)
 def timestamp(time):
 	"""
 	Converts a datetime object to a Unix timestamp.
 	"""
-	unixEpoch = datetime.utcfromtimestamp(0)
-	return int((time - unixEpoch).total_seconds())
+	return int((time - _unixEpoch).total_seconds())
 
 def isoTime(time):
 	"""
@@ -240,3 +256,135 @@ def expandIPv6Address(ip):
 		if pieceLen < 4:
 			pieces[index] = "{}{}".format("".join(["0" for i in range(4 - pieceLen)]), piece)
 	return ":".join(pieces)
+
+def ipAddressToInt(ip):
+	"""
+	Converts an IP address to a tuple of its numeric value and its length in
+	bits (32 for IPv4, 128 for IPv6). IPv4-mapped IPv6 addresses are converted
+	to their IPv4 address. Raises ValueError if the parameter isn't an IP
+	address.
+	"""
+	try:
+		return int(hexlify(socket.inet_pton(socket.AF_INET, ip)), 16), 32
+	except socket.error:
+		pass
+	try:
+		address = int(hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
+	except socket.error:
+		raise ValueError("Not a valid IP address: {}".format(ip))
+	if address >> 32 == 0xffff:
+		return address & 0xffffffff, 32
+	return address, 128
+
+def parseCIDR(mask):
+	"""
+	Parses an IP address or a network in CIDR notation (address/prefix length)
+	into a tuple of the numeric network address, the prefix length, and the
+	address length in bits. Raises ValueError if the mask isn't valid.
+	"""
+	ip, slash, prefixLengthStr = mask.partition("/")
+	address, bits = ipAddressToInt(ip)
+	if not slash:
+		return address, bits, bits
+	try:
+		prefixLength = int(prefixLengthStr)
+	except ValueError:
+		raise ValueError("Not a valid prefix length: {}".format(prefixLengthStr))
+	if bits == 32 and ":" in ip: # An IPv4-mapped address given with an IPv6 prefix length
+		prefixLength -= 96
+	if prefixLength < 0 or prefixLength > bits:
+		raise ValueError("Not a valid prefix length: {}".format(prefixLengthStr))
+	hostBits = bits - prefixLength
+	return address >> hostBits << hostBits, prefixLength, bits
+
+def formatCIDR(network, prefixLength, bits):
+	"""
+	Formats a network address as returned by parseCIDR in CIDR notation.
+	"""
+	if bits == 32:
+		ip = socket.inet_ntop(socket.AF_INET, unhexlify("{:08x}".format(network)))
+	else:
+		ip = socket.inet_ntop(socket.AF_INET6, unhexlify("{:032x}".format(network)))
+	return "{}/{}".format(ip, prefixLength)
+
+_noValue = object()
+class CIDRTree(object):
+	"""
+	Maps IP networks (in CIDR notation) to values and finds the networks
+	containing a given IP address. Networks are stored in a binary trie over
+	the bits of the network address, so a lookup takes time proportional to
+	the length of the address rather than the number of stored networks.
+	"""
+	def __init__(self):
+		self._roots = {
+			32: [None, None, _noValue],
+			128: [None, None, _noValue]
+		}
+		self._count = 0
+	
+	def __len__(self):
+		return self._count
+	
+	def add(self, mask, value):
+		"""
+		Adds a network with the given value, replacing the value of the
+		network if it's already present. Raises ValueError if the mask isn't
+		valid.
+		"""
+		network, prefixLength, bits = parseCIDR(mask)
+		node = self._roots[bits]
+		for bitIndex in xrange(bits - 1, bits - prefixLength - 1, -1):
+			bit = (network >> bitIndex) & 1
+			if node[bit] is None:
+				node[bit] = [None, None, _noValue]
+			node = node[bit]
+		if node[2] is _noValue:
+			self._count += 1
+		node[2] = value
+	
+	def remove(self, mask):
+		"""
+		Removes a network. Returns whether the network was present.
+		"""
+		try:
+			network, prefixLength, bits = parseCIDR(mask)
+		except ValueError:
+			return False
+		path = []
+		node = self._roots[bits]
+		for bitIndex in xrange(bits - 1, bits - prefixLength - 1, -1):
+			bit = (network >> bitIndex) & 1
+			if node[bit] is None:
+				return False
+			path.append((node, bit))
+			node = node[bit]
+		if node[2] is _noValue:
+			return False
+		node[2] = _noValue
+		self._count -= 1
+		while path and node[0] is None and node[1] is None and node[2] is _noValue: # Prune branches that no longer lead to any network
+			parent, bit = path.pop()
+			parent[bit] = None
+			node = parent
+		return True
+	
+	def matches(self, ip):
+		"""
+		Returns the values of all networks containing the given IP address,
+		from the least specific network to the most specific.
+		"""
+		try:
+			address, bits = ipAddressToInt(ip)
+		except ValueError:
+			return []
+		values = []
+		node = self._roots[bits]
+		bitIndex = bits - 1
+		while node is not None:
+			if node[2] is not _noValue:
+				values.append(node[2])
+			if bitIndex < 0:
+				break
+			node = node[(address >> bitIndex) & 1]
+			bitIndex -= 1
+		return values